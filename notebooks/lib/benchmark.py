@@ -0,0 +1,254 @@
+from contextlib import contextmanager, redirect_stderr
+from functools import partial
+from typing import Callable
+from lancedb.rerankers import Reranker
+from lib.data import load_query_items
+from lib.db import get_table
+from lib.embedding_cache import EmbeddingCache, set_embedding_cache
+from lib.models import QueryItem, CachedOpenAIEmbeddings
+from lib.providers import LocalHashingEmbedder, set_provider
+from lib.timing import collect_stage_times, record_stage
+import lib.bm25
+import lib.exact
+import lib.query
+import argparse
+import datetime
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+LANCE_DIR_PATH = os.path.join(BASE_PATH, "../../lance")
+DATA_DIR = os.path.join(BASE_PATH, "../../data")
+RESULTS_DIR = os.path.join(BASE_PATH, "../../benchmarks")
+
+PERCENTILES = [50, 95, 99]
+
+
+class LocalReranker(Reranker):
+    """
+    Stand-in for a hosted reranker which keeps the original ordering after sleeping for `latency` seconds per query
+    """
+
+    def __init__(self, latency: float, return_score="relevance", **kwargs):
+        super().__init__(return_score)
+        self.latency = latency
+
+    def _rerank(self, results: pa.Table) -> pa.Table:
+        time.sleep(self.latency)
+        scores = np.linspace(1, 0, len(results), dtype=np.float32)
+        return results.append_column("_relevance_score", pa.array(scores))
+
+    def rerank_hybrid(self, query: str, vector_results: pa.Table, fts_results):
+        return self._rerank(self.merge_results(vector_results, fts_results))
+
+    def rerank_vector(self, query: str, vector_results: pa.Table):
+        return self._rerank(vector_results)
+
+    def rerank_fts(self, query: str, fts_results: pa.Table):
+        return self._rerank(fts_results)
+
+
+@contextmanager
+def offline(embedding_latency: float, rerank_latency: float):
+    """
+    Swaps every external call made by the `lib.query` strategies for a local stand-in with a fixed latency. A temporary embedding
+    cache is used so that the fake embeddings never end up in the real one.
+    """
+    previous_embedder = set_provider(
+        "embedding", LocalHashingEmbedder(latency=embedding_latency)
+    )
+    previous_cache = set_embedding_cache(
+        EmbeddingCache(os.path.join(tempfile.mkdtemp(), "embeddings.sqlite"))
+    )
+    previous = (
+        lib.query.CohereReranker,
+        CachedOpenAIEmbeddings.generate_embeddings,
+    )
+
+    def generate_embeddings(self, texts):
+        with record_stage("embedding"):
+            return LocalHashingEmbedder(self.ndims(), embedding_latency).embed(
+                list(texts)
+            )
+
+    lib.query.CohereReranker = lambda **kwargs: LocalReranker(rerank_latency)
+    CachedOpenAIEmbeddings.generate_embeddings = generate_embeddings
+    try:
+        yield
+    finally:
+        (
+            lib.query.CohereReranker,
+            CachedOpenAIEmbeddings.generate_embeddings,
+        ) = previous
+        set_embedding_cache(previous_cache)
+        set_provider("embedding", previous_embedder)
+
+
+def get_strategies(cohere_model: str = "rerank-english-v3.0"):
+    # Only the chunk_id is needed to score a strategy, so don't pay for reading back text and vectors
+    projected = {"columns": ["chunk_id"], "result_format": "hits"}
+    return {
+        "fts": partial(lib.query.fts_search, **projected),
+        "bm25": lib.bm25.bm25_search,
+        "vector": partial(lib.query.vector_search, **projected),
+        "exact_vector": lib.exact.exact_vector_search,
+        "hybrid": partial(lib.query.hybrid_search, **projected),
+        "linear_combination": partial(
+            lib.query.linear_combination_search, vector_search_weight=0.7, **projected
+        ),
+        "cohere_rerank": partial(
+            lib.query.cohere_rerank_search, model_name=cohere_model, **projected
+        ),
+    }
+
+
+def summarize(latencies: list[float], stage_times: list[dict[str, float]]):
+    latencies = np.array(latencies)
+    embedding = np.array([stages.get("embedding", 0) for stages in stage_times])
+    rerank = np.array([stages.get("rerank", 0) for stages in stage_times])
+    materialize = np.array([stages.get("materialize", 0) for stages in stage_times])
+    search = latencies - embedding - rerank - materialize
+    return {
+        "n_queries": len(latencies),
+        "qps": len(latencies) / latencies.sum() if latencies.sum() else 0,
+        **{f"p{p}_ms": float(np.percentile(latencies, p) * 1000) for p in PERCENTILES},
+        "mean_ms": float(latencies.mean() * 1000),
+        "stage_ms": {
+            "embedding": float(embedding.mean() * 1000),
+            "search": float(search.mean() * 1000),
+            "rerank": float(rerank.mean() * 1000),
+            "materialize": float(materialize.mean() * 1000),
+        },
+    }
+
+
+def benchmark_strategy(table, queries: list[QueryItem], search_fn: Callable, top_k):
+    latencies, stage_times = [], []
+    # The strategies draw a progress bar per call which would drown out everything else here
+    with redirect_stderr(io.StringIO()):
+        for query in queries:
+            with collect_stage_times() as stages:
+                start = time.perf_counter()
+                search_fn(table, [query], top_k)
+                latencies.append(time.perf_counter() - start)
+            stage_times.append(stages)
+    return summarize(latencies, stage_times)
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=BASE_PATH,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmark(
+    table,
+    queries: list[QueryItem],
+    top_k: int = 25,
+    strategies: dict[str, Callable] | None = None,
+    warmup: int = 3,
+):
+    strategies = strategies or get_strategies()
+    results = {}
+    for name, search_fn in strategies.items():
+        # A few warmup queries so that index loading doesn't end up in the percentiles
+        benchmark_strategy(table, queries[:warmup], search_fn, top_k)
+        results[name] = benchmark_strategy(table, queries, search_fn, top_k)
+    return results
+
+
+def compare(current: dict, baseline: dict):
+    rows = []
+    for name, stats in current["strategies"].items():
+        if name not in baseline["strategies"]:
+            continue
+        previous = baseline["strategies"][name]
+        for metric in ["p50_ms", "p95_ms", "p99_ms", "qps"]:
+            change = (
+                (stats[metric] - previous[metric]) / previous[metric] * 100
+                if previous[metric]
+                else 0
+            )
+            rows.append((name, metric, previous[metric], stats[metric], change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Latency and throughput benchmark for the lib.query strategies"
+    )
+    parser.add_argument(
+        "--queries", default=os.path.join(DATA_DIR, "queries_single_label.jsonl")
+    )
+    parser.add_argument("--table", default="ms_marco")
+    parser.add_argument("--top-k", type=int, default=25)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--strategies", nargs="*", default=None)
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--rerank-latency-ms", type=float, default=100)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    args = parser.parse_args()
+
+    db = lancedb.connect(LANCE_DIR_PATH)
+    table = get_table(db, args.table)
+    queries = load_query_items(args.queries, args.limit)
+    strategies = get_strategies()
+    if args.strategies:
+        strategies = {name: strategies[name] for name in args.strategies}
+
+    if args.offline:
+        with offline(args.embedding_latency_ms / 1000, args.rerank_latency_ms / 1000):
+            results = run_benchmark(table, queries, args.top_k, strategies)
+    else:
+        results = run_benchmark(table, queries, args.top_k, strategies)
+
+    commit = get_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(),
+        "table": args.table,
+        "queries": os.path.basename(args.queries),
+        "top_k": args.top_k,
+        "offline": args.offline,
+        "strategies": results,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, stats in results.items():
+        print(
+            f"{name:>20}: p50 {stats['p50_ms']:.1f}ms p95 {stats['p95_ms']:.1f}ms "
+            f"p99 {stats['p99_ms']:.1f}ms qps {stats['qps']:.1f} stages {stats['stage_ms']}"
+        )
+    print(f"Results saved to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, metric, previous, current, change in compare(report, baseline):
+            print(
+                f"{name:>20} {metric:>7}: {previous:.2f} -> {current:.2f} ({change:+.1f}%)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from collections import Counter
+from lancedb.table import Table
+from scipy import sparse
+from tqdm import tqdm
+from lib.embedding_cache import CACHE_DIR
+from lib.models import QueryItem
+from lib.string_helpers import strip_punctuation
+from lib.tracing import traced_search
+import json
+import os
+import re
+import numpy as np
+
+BM25_DIR = os.path.join(CACHE_DIR, "bm25")
+
+# Mirrors tantivy's default tokenizer which splits on non alphanumeric characters and lowercases
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+# Upper bound on the (queries x documents) scores held at once, each one takes 8 bytes with its column index
+MAX_BLOCK_SCORES = 32_000_000
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Lexical index stored as a sparse (vocab x documents) matrix of precomputed BM25 term weights. Scoring a batch of queries is
+    then a single sparse matmul followed by a top-k over each row.
+    """
+
+    def __init__(
+        self,
+        term_weights: sparse.csr_matrix,
+        vocab: dict[str, int],
+        chunk_ids: np.ndarray,
+    ):
+        self.term_weights = term_weights
+        self.vocab = vocab
+        self.chunk_ids = chunk_ids
+
+    @classmethod
+    def build(
+        cls,
+        texts,
+        chunk_ids: list[str],
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> "BM25Index":
+        vocab: dict[str, int] = {}
+        rows, cols, counts = [], [], []
+        for doc_id, text in enumerate(tqdm(texts, desc="Tokenizing documents")):
+            for term, count in Counter(tokenize(text)).items():
+                rows.append(vocab.setdefault(term, len(vocab)))
+                cols.append(doc_id)
+                counts.append(count)
+
+        n_docs = len(chunk_ids)
+        tf = sparse.csr_matrix(
+            (np.array(counts, dtype=np.float32), (rows, cols)),
+            shape=(len(vocab), n_docs),
+        )
+
+        doc_lengths = np.asarray(tf.sum(axis=0)).ravel()
+        avg_doc_length = doc_lengths.mean() if n_docs else 0
+        doc_freq = np.diff(tf.indptr)
+        # Same idf as Lucene/tantivy so scores line up with fts_search
+        idf = np.log1p((n_docs - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+
+        tf = tf.tocoo()
+        length_norm = k1 * (1 - b + b * doc_lengths[tf.col] / avg_doc_length)
+        weights = idf[tf.row] * tf.data * (k1 + 1) / (tf.data + length_norm)
+        term_weights = sparse.csr_matrix(
+            (weights.astype(np.float32), (tf.row, tf.col)), shape=tf.shape
+        )
+        return cls(term_weights, vocab, np.array(chunk_ids, dtype=object))
+
+    @classmethod
+    def from_table(
+        cls, table: Table, text_column: str = "text", **kwargs
+    ) -> "BM25Index":
+        columns = table.to_lance().to_table(columns=["chunk_id", text_column])
+        return cls.build(
+            columns[text_column].to_pylist(), columns["chunk_id"].to_pylist(), **kwargs
+        )
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        sparse.save_npz(os.path.join(path, "term_weights.npz"), self.term_weights)
+        np.save(os.path.join(path, "chunk_ids.npy"), self.chunk_ids.astype(str))
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump(self.vocab, f)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        term_weights = sparse.load_npz(os.path.join(path, "term_weights.npz")).tocsr()
+        chunk_ids = np.load(os.path.join(path, "chunk_ids.npy")).astype(object)
+        with open(os.path.join(path, "vocab.json")) as f:
+            vocab = json.load(f)
+        return cls(term_weights, vocab, chunk_ids)
+
+    def encode_queries(self, queries: list[str]) -> sparse.csr_matrix:
+        rows, cols, counts = [], [], []
+        for query_id, query in enumerate(queries):
+            for term, count in Counter(tokenize(query)).items():
+                if term in self.vocab:
+                    rows.append(query_id)
+                    cols.append(self.vocab[term])
+                    counts.append(count)
+        return sparse.csr_matrix(
+            (np.array(counts, dtype=np.float32), (rows, cols)),
+            shape=(len(queries), len(self.vocab)),
+        )
+
+    def search_batch(
+        self, queries: list[str], top_k: int, block_size: int | None = None
+    ):
+        """
+        Returns the top_k chunk ids and scores for every query. Queries are scored in blocks to bound the memory used by the
+        (queries x documents) score matrix, by default the block is sized so it holds at most `MAX_BLOCK_SCORES` scores even
+        if every query matches every document.
+        """
+        if block_size is None:
+            block_size = max(1, MAX_BLOCK_SCORES // max(len(self.chunk_ids), 1))
+        results = []
+        for start in range(0, len(queries), block_size):
+            scores = (
+                self.encode_queries(queries[start : start + block_size])
+                @ self.term_weights
+            ).tocsr()
+            for row in range(scores.shape[0]):
+                lo, hi = scores.indptr[row], scores.indptr[row + 1]
+                row_scores, row_docs = scores.data[lo:hi], scores.indices[lo:hi]
+                if len(row_scores) > top_k:
+                    keep = np.argpartition(-row_scores, top_k)[:top_k]
+                    row_scores, row_docs = row_scores[keep], row_docs[keep]
+                order = np.argsort(-row_scores, kind="stable")
+                results.append(
+                    [
+                        {"chunk_id": chunk_id, "_score": float(score)}
+                        for chunk_id, score in zip(
+                            self.chunk_ids[row_docs[order]], row_scores[order]
+                        )
+                    ]
+                )
+        return results
+
+
+_indexes: dict[tuple[str, int], BM25Index] = {}
+
+
+def _cache_index(key: tuple[str, int], index: BM25Index):
+    # Drop the indexes of older table versions so the cache doesn't grow with every write to the table
+    for stale in [
+        other for other in _indexes if other[0] == key[0] and other[1] < key[1]
+    ]:
+        del _indexes[stale]
+    _indexes[key] = index
+
+
+def get_bm25_index(table: Table, rebuild: bool = False) -> BM25Index:
+    """
+    Loads the BM25 index saved for this table, rebuilding it if the table has been written to since it was built. The latest
+    loaded index of each table is kept in memory so that searching one query at a time doesn't reload it from disk.
+    """
+    key = (table.name, table.version)
+    if not rebuild and key in _indexes:
+        return _indexes[key]
+
+    path = os.path.join(BM25_DIR, table.name)
+    version_path = os.path.join(path, "version")
+    if not rebuild and os.path.exists(version_path):
+        with open(version_path) as f:
+            if f.read() == str(table.version):
+                index = BM25Index.load(path)
+                _cache_index(key, index)
+                return index
+
+    index = BM25Index.from_table(table)
+    index.save(path)
+    with open(version_path, "w") as f:
+        f.write(str(table.version))
+    _cache_index(key, index)
+    return index
+
+
+@traced_search
+def bm25_search(table: Table, queries: list[QueryItem], top_k: int):
+    """
+    Drop in replacement for `fts_search` which scores every query in one batch against a sparse BM25 index of the table
+    """
+    index = get_bm25_index(table)
+    return index.search_batch(
+        [strip_punctuation(query.query) for query in queries], top_k
+    )
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from lib.data import get_labels
+from lib.query import classify_queries
+from lib.query_cache import normalize_query
+import os
+import pickle
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_PATH, "../../data")
+
+
+class LocalCategoryClassifier:
+    """
+    This is a TF-IDF + logistic regression classifier for the arxiv categories used by `metadata_search`. Queries that we're not
+    confident about are escalated to the LLM classifier and every prediction is cached by normalized query.
+    """
+
+    def __init__(self, threshold: float = 0.7, max_cache_entries: int = 100_000):
+        self.threshold = threshold
+        self.max_cache_entries = max_cache_entries
+        self.model = make_pipeline(
+            TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=1),
+            LogisticRegression(max_iter=1000, C=10),
+        )
+        self.local_predictions = 0
+        self.llm_predictions = 0
+        self._cache: OrderedDict[str, str] = OrderedDict()
+
+    def fit(self, texts: list[str], categories: list[str]):
+        self.model.fit(texts, categories)
+        self._cache.clear()
+        return self
+
+    @classmethod
+    def from_files(
+        cls,
+        paper_path: str = os.path.join(DATA_DIR, "arxiv_metadata.jsonl"),
+        question_path: str | None = os.path.join(DATA_DIR, "category_questions.jsonl"),
+        **kwargs,
+    ):
+        texts, categories = [], []
+        for paper in get_labels(paper_path):
+            texts.append(paper["text"])
+            categories.append(paper["category"])
+
+        # Note that category_questions.jsonl is also what we evaluate metadata_search against, so pass None for a clean eval
+        if question_path:
+            for question in get_labels(question_path):
+                texts.append(question["query"])
+                categories.append(question["category"])
+
+        return cls(**kwargs).fit(texts, categories)
+
+    def predict(self, queries: list[str]) -> list[tuple[str, float]]:
+        probabilities = self.model.predict_proba(queries)
+        labels = self.model.classes_[probabilities.argmax(axis=1)]
+        return list(zip(labels.tolist(), probabilities.max(axis=1).tolist()))
+
+    def _remember(self, key: str, category: str):
+        self._cache[key] = category
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_cache_entries:
+            self._cache.popitem(last=False)
+
+    async def classify(self, queries: list[str]) -> list[str]:
+        keys = [normalize_query(query) for query in queries]
+        categories = [self._cache.get(key) for key in keys]
+
+        uncached = {}
+        for key, query, category in zip(keys, queries, categories):
+            if category is None:
+                uncached.setdefault(key, query)
+
+        escalate = []
+        if uncached:
+            for key, (category, confidence) in zip(
+                uncached.keys(), self.predict(list(uncached.values()))
+            ):
+                if confidence >= self.threshold:
+                    self._remember(key, category)
+                    self.local_predictions += 1
+                else:
+                    escalate.append((key, uncached[key]))
+
+        if escalate:
+            responses = await classify_queries([query for _, query in escalate])
+            for (key, _), response in zip(escalate, responses):
+                self._remember(key, response.category)
+                self.llm_predictions += 1
+
+        return [
+            self._cache.get(key) or category for key, category in zip(keys, categories)
+        ]
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: str) -> "LocalCategoryClassifier":
+        with open(path, "rb") as f:
+            return pickle.load(f)
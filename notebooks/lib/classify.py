@@ -1,23 +1,89 @@
 from lib.models import QueryTagger, Capability, QueryItem
-from tenacity import retry, stop_after_attempt, wait_random_exponential
-from asyncio import Semaphore
-import instructor
-from openai import AsyncOpenAI
+from lib.llm import get_gateway
+from asyncio import Semaphore, Future, get_running_loop
+from concurrent.futures import Executor, ThreadPoolExecutor
 from typing import Callable
 from tqdm.asyncio import tqdm_asyncio as asyncio
 
-client = instructor.from_openai(AsyncOpenAI())
 
+class TopicBatcher:
+    """
+    Collects queries and runs the topic model on them in a worker thread, either once `max_batch_size` queries are waiting or
+    `max_wait_ms` after the first one arrived. This keeps models like BERTopic from blocking the event loop.
 
-@retry(
-    wait=wait_random_exponential(multiplier=1, min=10, max=90),
-    stop=stop_after_attempt(3),
-)
-async def tag_query(
-    query: str, sem: Semaphore, topic_model: Callable[[str], int]
-) -> QueryTagger:
+    `batch_topic_model` must return one topic per query, for BERTopic that's `lambda queries: model.transform(queries)[0]` since
+    `transform` returns a `(topics, probs)` tuple.
+    """
+
+    def __init__(
+        self,
+        batch_topic_model: Callable[[list[str]], list[int]],
+        max_batch_size: int = 64,
+        max_wait_ms: float = 20,
+        executor: Executor | None = None,
+    ):
+        self.batch_topic_model = batch_topic_model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        # Only shut down the executor in `close` if we created it
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._pending: list[tuple[str, Future]] = []
+        self._timer = None
+
+    async def assign(self, query: str) -> int:
+        future = get_running_loop().create_future()
+        self._pending.append((query, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = get_running_loop().call_later(
+                self.max_wait_ms / 1000, self._flush
+            )
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        def resolve(result: Future):
+            # Anything raised in a done callback is only logged, so every future has to be resolved here or its caller hangs
+            try:
+                topics = list(result.result())
+                if len(topics) != len(batch):
+                    raise ValueError(
+                        f"Topic model returned {len(topics)} topics for {len(batch)} queries"
+                    )
+                for (_, future), topic in zip(batch, topics):
+                    if not future.done():
+                        future.set_result(int(topic))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+        get_running_loop().run_in_executor(
+            self.executor, self.batch_topic_model, [query for query, _ in batch]
+        ).add_done_callback(resolve)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+
+async def tag_query(query: str, sem: Semaphore, topics: TopicBatcher) -> QueryTagger:
+    # The topic is assigned in the background while we wait on the LLM
+    topic = get_running_loop().create_task(topics.assign(query))
     async with sem:
-        resp = await client.chat.completions.create(
+        resp = await get_gateway().create(
             model="gpt-3.5-turbo",
             response_model=Capability,
             messages=[
@@ -30,21 +96,37 @@ async def tag_query(
             ],
             max_retries=3,
         )
-        return QueryTagger(
-            **{
-                "capabilities": resp.capabilities,
-                "topic_model": topic_model(query),
-                "query": query,
-            }
-        )
+    return QueryTagger(
+        **{
+            "capabilities": resp.capabilities,
+            "topic_model": await topic,
+            "query": query,
+        }
+    )
 
 
 async def tag_queries(
     queries: list[QueryItem],
     max_concurrent_calls: int,
-    topic_model: Callable[[str], int],
+    topic_model: Callable[[str], int] | None = None,
+    batch_topic_model: Callable[[list[str]], list[int]] | None = None,
+    topic_batch_size: int = 64,
+    topic_max_wait_ms: float = 20,
 ):
+    """
+    Pass `batch_topic_model` to assign topics a batch at a time (eg. `lambda queries: topic_model.transform(queries)[0]` for
+    BERTopic), otherwise `topic_model` is called once per query in a worker thread.
+    """
+    if batch_topic_model is None:
+        if topic_model is None:
+            raise ValueError("Either topic_model or batch_topic_model is required")
+        batch_topic_model = lambda batch: [topic_model(query) for query in batch]
+
     sem = Semaphore(max_concurrent_calls)
-    coros = [tag_query(item.query, sem, topic_model) for item in queries]
-    res = await asyncio.gather(*coros)
+    topics = TopicBatcher(batch_topic_model, topic_batch_size, topic_max_wait_ms)
+    try:
+        coros = [tag_query(item.query, sem, topics) for item in queries]
+        res = await asyncio.gather(*coros)
+    finally:
+        topics.close()
     return res
@@ -1,15 +1,103 @@
-from datasets import load_dataset, Dataset
+from itertools import batched
+from typing import TYPE_CHECKING
 from tqdm import tqdm
 import hashlib
 import json
-from lib.models import ArxivPaper
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+from lib.models import QueryItem
 from pydantic import BaseModel
+from lib.embedding_cache import CACHE_DIR
+from lib.dedup import NearDuplicateIndex, load_aliases, resolve_chunk_ids
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+    from lib.schemas import ArxivPaper
 
 remain_count = {}
 
 
-def get_dataset(n: int):
-    return load_dataset("ms_marco", "v1.1", split="train", streaming=True).take(n)
+def load_dataset(*args, **kwargs):
+    # datasets is slow to import so we only pull it in once we actually need to download something
+    from datasets import load_dataset
+
+    return load_dataset(*args, **kwargs)
+
+
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, "snapshots")
+MS_MARCO_COLUMNS = ["query", "query_id", "query_type", "answers", "passages"]
+ARXIV_COLUMNS = ["title", "authors", "categories", "abstract"]
+ARXIV_CATEGORIES = ["cs.AI", "cs.IR", "stat.ML"]
+
+
+def _snapshot_path(dataset_name: str, **key) -> str:
+    digest = hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()[:12]
+    return os.path.join(
+        SNAPSHOT_DIR, f"{dataset_name.replace('/', '__')}-{digest}.parquet"
+    )
+
+
+def write_snapshot(rows, path: str, batch_size: int = 1000) -> str:
+    """
+    Writes the rows to Parquet a batch at a time. The file is only moved into place once every row has been written so an
+    interrupted download never leaves a partial snapshot behind.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    writer = None
+    try:
+        for batch in batched(rows, batch_size):
+            table = pa.Table.from_pylist(
+                list(batch), schema=writer.schema if writer else None
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(path + ".tmp", table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        raise ValueError(f"No rows were written to the snapshot at {path}")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def read_snapshot(
+    path: str,
+    columns: list[str] | None = None,
+    filter: pc.Expression | None = None,
+    batch_size: int = 1024,
+):
+    dataset = ds.dataset(path, format="parquet")
+    for batch in dataset.to_batches(
+        columns=columns, filter=filter, batch_size=batch_size, use_threads=True
+    ):
+        yield from batch.to_pylist()
+
+
+def get_dataset(n: int, use_snapshot: bool = True):
+    """
+    The first call streams the first `n` rows of MS Marco into a local Parquet snapshot, every call after that reads the
+    snapshot and doesn't need the network
+    """
+    if not use_snapshot:
+        return load_dataset("ms_marco", "v1.1", split="train", streaming=True).take(n)
+
+    path = _snapshot_path(
+        "ms_marco", config="v1.1", split="train", n=n, columns=MS_MARCO_COLUMNS
+    )
+    if not os.path.exists(path):
+        stream = (
+            load_dataset("ms_marco", "v1.1", split="train", streaming=True)
+            .select_columns(MS_MARCO_COLUMNS)
+            .take(n)
+        )
+        write_snapshot(tqdm(stream, total=n, desc="Snapshotting ms_marco"), path)
+    return read_snapshot(path, MS_MARCO_COLUMNS)
 
 
 def is_valid_category(
@@ -24,22 +112,73 @@ def is_valid_category(
     return False
 
 
-def download_arxiv_dataset(desired_category_count: int):
-    desired_categories = ["cs.AI", "cs.IR", "stat.ML"]
-    remain_count = {category: desired_category_count for category in desired_categories}
-    return (
-        load_dataset("gfissore/arxiv-abstracts-2021", split="train", streaming=True)
-        .filter(
-            lambda example, idx: is_valid_category(
-                example, desired_categories, remain_count
+def take_category_quota(rows, desired_categories: list[str], count: int):
+    remain_count = {category: count for category in desired_categories}
+    for row in rows:
+        category = row["categories"][0]
+        if remain_count.get(category, 0) > 0:
+            remain_count[category] -= 1
+            yield {
+                **{column: row[column] for column in ARXIV_COLUMNS},
+                "primary_category": category,
+            }
+            if not any(remain_count.values()):
+                return
+
+
+def download_arxiv_dataset(
+    desired_category_count: int,
+    desired_categories: list[str] = ARXIV_CATEGORIES,
+    use_snapshot: bool = True,
+):
+    """
+    The first call streams the arxiv dump until every category has `desired_category_count` papers and saves them as a Parquet
+    snapshot. Later calls read the snapshot, only loading the columns we need and pushing the category filter down to the scan.
+    """
+    if not use_snapshot:
+        remain_count = {
+            category: desired_category_count for category in desired_categories
+        }
+        return (
+            load_dataset("gfissore/arxiv-abstracts-2021", split="train", streaming=True)
+            .filter(
+                lambda example, idx: is_valid_category(
+                    example, desired_categories, remain_count
+                ),
+                with_indices=True,
+            )
+            .take(desired_category_count * len(desired_categories))
+        )
+
+    path = _snapshot_path(
+        "gfissore/arxiv-abstracts-2021",
+        split="train",
+        categories=sorted(desired_categories),
+        n=desired_category_count,
+        columns=ARXIV_COLUMNS,
+    )
+    if not os.path.exists(path):
+        stream = load_dataset(
+            "gfissore/arxiv-abstracts-2021", split="train", streaming=True
+        ).select_columns(ARXIV_COLUMNS)
+        write_snapshot(
+            tqdm(
+                take_category_quota(stream, desired_categories, desired_category_count),
+                total=desired_category_count * len(desired_categories),
+                desc="Snapshotting arxiv abstracts",
             ),
-            with_indices=True,
+            path,
         )
-        .take(desired_category_count * len(desired_categories))
+    return read_snapshot(
+        path,
+        ARXIV_COLUMNS,
+        filter=pc.field("primary_category").isin(desired_categories),
     )
 
 
-def format_arxiv_dataset(ds: Dataset) -> list[ArxivPaper]:
+def format_arxiv_dataset(ds: "Dataset") -> list["ArxivPaper"]:
+    from lib.schemas import ArxivPaper
+
     data = []
     for row in tqdm(ds, desc="Formatting entries"):
         combined_chunk = f"Title:{row['title']}\nAbstract:{row['abstract']}"
@@ -59,7 +198,7 @@ def format_arxiv_dataset(ds: Dataset) -> list[ArxivPaper]:
     return data
 
 
-def generate_data_and_labels(dataset: Dataset):
+def generate_data_and_labels(dataset: "Dataset"):
     passages = set()
     data = []
     labels = []
@@ -90,6 +229,59 @@ def generate_data_and_labels(dataset: Dataset):
     return data, labels
 
 
+def stream_passages(
+    dataset: "Dataset",
+    labels: list[dict],
+    near_duplicates: NearDuplicateIndex | None = None,
+):
+    """
+    Streaming version of `generate_data_and_labels`. Unique passages are yielded as they are read and labels are appended to
+    `labels`, so only the 16 byte md5 digest of each passage we've seen is kept around.
+
+    Pass a `lib.dedup.NearDuplicateIndex` to also drop near duplicates, labels that select one point at the passage it was
+    collapsed into and the dropped chunk ids are kept in `near_duplicates.aliases`.
+    """
+    seen = set()
+    for row in dataset:
+        selected_passages = []
+        for idx, passage in enumerate(row["passages"]["passage_text"]):
+            digest = hashlib.md5(passage.encode())
+            if digest.digest() in seen:
+                continue
+
+            seen.add(digest.digest())
+            passage_data_obj = {"text": passage, "chunk_id": digest.hexdigest()}
+            canonical = (
+                near_duplicates.add(passage_data_obj["chunk_id"], passage)
+                if near_duplicates is not None
+                else passage_data_obj["chunk_id"]
+            )
+            if canonical == passage_data_obj["chunk_id"]:
+                yield passage_data_obj
+            else:
+                passage_data_obj = {"text": passage, "chunk_id": canonical}
+
+            if row["passages"]["is_selected"][idx]:
+                selected_passages.append(passage_data_obj)
+
+        if selected_passages:
+            labels.append(
+                {
+                    "query": row["query"],
+                    "selected_passages": selected_passages,
+                    "answer": row["answers"],
+                    "query_id": row["query_id"],
+                    "query_type": row["query_type"],
+                }
+            )
+
+    print(f"Extracted {len(seen)} unique passages and {len(labels)} test queries")
+    if near_duplicates is not None:
+        print(
+            f"Collapsed {len(near_duplicates.aliases)} near duplicate passages into their canonical chunk"
+        )
+
+
 def save_labels(labels: list[object | BaseModel], file_path):
     with open(file_path, "w") as file:
         for label in labels:
@@ -140,12 +332,118 @@ def generate_test_labels(labels, has_single_label: bool):
     return res
 
 
-def get_labels(file_path):
+def get_labels(file_path, resolve_aliases: bool = True):
     """
-    We assume that this is a .jsonl file
+    We assume that this is a .jsonl file. Labels that point at a passage which was collapsed into a near duplicate at ingest are
+    pointed at the passage that was kept instead (see `lib.dedup`), pass `resolve_aliases=False` for the raw labels.
     """
+    aliases = load_aliases() if resolve_aliases else {}
     with open(file_path, "r") as f:
         labels = []
         for line in f:
-            labels.append(json.loads(line))
+            label = json.loads(line)
+            if aliases and "selected_chunk_ids" in label:
+                label["selected_chunk_ids"] = resolve_chunk_ids(
+                    label["selected_chunk_ids"], aliases
+                )
+            labels.append(label)
     return labels
+
+
+def to_query_item(item: dict) -> QueryItem:
+    # The single label files store a single chunk id rather than a list
+    selected_chunk_ids = item["selected_chunk_ids"]
+    if isinstance(selected_chunk_ids, str):
+        selected_chunk_ids = [selected_chunk_ids]
+    return QueryItem(query=item["query"], selected_chunk_ids=selected_chunk_ids)
+
+
+def load_query_items(path: str, limit: int | None = None):
+    labels = get_labels(path)[:limit]
+    return [to_query_item(item) for item in labels]
+
+
+def _columnar_cache_path(file_path: str) -> str:
+    file_path = os.path.abspath(file_path)
+    digest = hashlib.md5(file_path.encode()).hexdigest()[:8]
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(CACHE_DIR, "columnar", f"{name}-{digest}.parquet")
+
+
+def _source_fingerprint(file_path: str) -> dict[bytes, bytes]:
+    stat = os.stat(file_path)
+    return {
+        b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+        b"source_size": str(stat.st_size).encode(),
+    }
+
+
+def get_columnar_cache(file_path: str) -> str:
+    """
+    Converts a .jsonl file into a Parquet file the first time it is read and returns its path. The Parquet file is rebuilt
+    whenever the mtime or size of the source file changes.
+    """
+    parquet_path = _columnar_cache_path(file_path)
+    fingerprint = _source_fingerprint(file_path)
+    if os.path.exists(parquet_path):
+        metadata = pq.read_schema(parquet_path).metadata or {}
+        if all(metadata.get(key) == value for key, value in fingerprint.items()):
+            return parquet_path
+
+    table = pa_json.read_json(file_path)
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), **fingerprint}
+    )
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+    pq.write_table(table, parquet_path + ".tmp")
+    os.replace(parquet_path + ".tmp", parquet_path)
+    return parquet_path
+
+
+def _resolve_label_aliases(table: pa.Table, aliases: dict[str, str]) -> pa.Table:
+    if not aliases or "selected_chunk_ids" not in table.column_names:
+        return table
+    idx = table.column_names.index("selected_chunk_ids")
+    column = table.column(idx)
+    resolved = [
+        None if chunk_ids is None else resolve_chunk_ids(chunk_ids, aliases)
+        for chunk_ids in column.to_pylist()
+    ]
+    return table.set_column(idx, table.field(idx), pa.array(resolved, type=column.type))
+
+
+def get_labels_table(
+    file_path, columns: list[str] | None = None, resolve_aliases: bool = True
+) -> pa.Table:
+    """
+    Columnar version of `get_labels` which memory maps the cached Parquet file and only reads `columns`. Aliases are resolved
+    as the labels are read like in `get_labels`, so the cache itself always holds the raw labels.
+    """
+    table = pq.read_table(
+        get_columnar_cache(file_path), columns=columns, memory_map=True
+    )
+    return _resolve_label_aliases(table, load_aliases() if resolve_aliases else {})
+
+
+def iter_labels(
+    file_path,
+    columns: list[str] | None = None,
+    batch_size: int = 1024,
+    resolve_aliases: bool = True,
+):
+    aliases = load_aliases() if resolve_aliases else {}
+    parquet_file = pq.ParquetFile(get_columnar_cache(file_path), memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield from _resolve_label_aliases(
+            pa.Table.from_batches([batch]), aliases
+        ).to_pylist()
+
+
+def iter_query_items(file_path, batch_size: int = 1024, resolve_aliases: bool = True):
+    """
+    Lazily builds a `QueryItem` for each row so we only pay for the pydantic models we actually use
+    """
+    for item in iter_labels(
+        file_path, ["query", "selected_chunk_ids"], batch_size, resolve_aliases
+    ):
+        yield to_query_item(item)
@@ -1,9 +1,21 @@
 from lancedb.pydantic import LanceModel
+from pydantic import BaseModel
 from itertools import batched
 from tqdm import tqdm
+import tantivy
+import os
+from lib.ingest import stream_into_async_table
+from lib.tracing import span
+
+
+def register_embedding_functions():
+    # Our tables store the name of their embedding function in their metadata and lancedb looks it up in its registry when
+    # it embeds a text query, so the functions need to be registered before a table is opened
+    import lib.schemas  # noqa: F401
 
 
 def get_table(db, table_name: str, schema: LanceModel | None = None):
+    register_embedding_functions()
     # We return the table if it exists
     if table_name in db.table_names():
         return db.open_table(table_name)
@@ -16,8 +28,124 @@ def get_table(db, table_name: str, schema: LanceModel | None = None):
     return db.create_table(table_name, schema=schema)
 
 
+def get_table_pool(db, table_name: str, size: int):
+    register_embedding_functions()
+    # Each handle keeps its own dataset state so they can be searched from separate threads
+    return [db.open_table(table_name) for _ in range(size)]
+
+
 def insert_data_into_table(table, data, batch_size=20):
     batches = batched(data, batch_size)
 
     for batch in tqdm(batches):
-        table.add(list(batch))
+        with span(
+            "lib.db.insert_data_into_table", table=table.name, batch_size=len(batch)
+        ):
+            table.add(list(batch))
+
+
+def _chunk_id(item) -> str:
+    return item.chunk_id if isinstance(item, BaseModel) else item["chunk_id"]
+
+
+def _as_row(item) -> dict:
+    return item.model_dump() if isinstance(item, BaseModel) else dict(item)
+
+
+def get_existing_chunk_ids(table) -> set[str]:
+    return set(table.to_lance().to_table(columns=["chunk_id"])["chunk_id"].to_pylist())
+
+
+def _get_changed_rows(table, items, batch_size=1000):
+    # The chunk_id is a md5 of the text so a matching id means the vector is still valid and only the other fields can differ
+    changed = []
+    for batch in batched(items, batch_size):
+        ids = ", ".join(f"'{_chunk_id(item)}'" for item in batch)
+        existing = {
+            row["chunk_id"]: row
+            for row in table.to_lance()
+            .to_table(filter=f"chunk_id IN ({ids})")
+            .to_pylist()
+        }
+        for item in batch:
+            row = _as_row(item)
+            current = existing[row["chunk_id"]]
+            if any(row[key] != current[key] for key in row if key != "vector"):
+                changed.append({**row, "vector": current["vector"]})
+    return changed
+
+
+def upsert_data_into_table(table, data, batch_size=20):
+    """
+    Content addressed upsert keyed on chunk_id. Only chunks that aren't in the table yet are embedded and added, chunks whose
+    other fields have changed are merged in with their existing vector and everything else is skipped.
+    """
+    existing = get_existing_chunk_ids(table)
+    new_items, matched_items, seen = [], [], set()
+    for item in data:
+        chunk_id = _chunk_id(item)
+        if chunk_id in seen:
+            continue
+        seen.add(chunk_id)
+        (matched_items if chunk_id in existing else new_items).append(item)
+
+    start_row = table.count_rows()
+    with span(
+        "lib.db.upsert_data_into_table", table=table.name, batch_size=len(seen)
+    ) as current:
+        changed = _get_changed_rows(table, matched_items)
+        if new_items:
+            insert_data_into_table(table, new_items, batch_size)
+        if changed:
+            table.merge_insert("chunk_id").when_matched_update_all().execute(changed)
+        current.set_attribute("inserted", len(new_items))
+        current.set_attribute("updated", len(changed))
+
+    print(
+        f"Inserted {len(new_items)}, updated {len(changed)} and skipped {len(matched_items) - len(changed)} chunks"
+    )
+    return {
+        "inserted": len(new_items),
+        "updated": len(changed),
+        "unchanged": len(matched_items) - len(changed),
+        "start_row": start_row,
+    }
+
+
+def update_fts_index(table, field_name: str, start_row: int, rebuild: bool = False):
+    """
+    Adds rows from `start_row` onwards to the existing tantivy index instead of rebuilding it. The index maps each document to
+    its row position so any update or delete means we need to `rebuild` it.
+    """
+    index_path = table._get_fts_index_path()
+    if rebuild or start_row == 0 or not os.path.exists(index_path):
+        table.create_fts_index(field_name, replace=True)
+        return
+
+    index = tantivy.Index.open(index_path)
+    writer = index.writer()
+    rows = table.to_lance().to_table(columns=[field_name], offset=start_row)
+    for row_id, text in enumerate(rows[field_name].to_pylist(), start=start_row):
+        document = tantivy.Document()
+        document.add_text(field_name, text)
+        document.add_integer("doc_id", row_id)
+        writer.add_document(document)
+    writer.commit()
+
+
+async def get_table_async(db, table_name: str, schema: LanceModel | None = None):
+    register_embedding_functions()
+    if table_name in await db.table_names():
+        return await db.open_table(table_name)
+
+    if schema is None:
+        raise ValueError(
+            f"Table {table_name} does not exist and no schema was provided"
+        )
+
+    return await db.create_table(table_name, schema=schema)
+
+
+async def insert_data_into_async_table(table, data, batch_size=20):
+    rows = (item.model_dump() if isinstance(item, BaseModel) else item for item in data)
+    return await stream_into_async_table(table, rows, batch_size=batch_size)
@@ -0,0 +1,254 @@
+from typing import Iterable
+from tqdm import tqdm
+from lib.models import QueryItem
+import argparse
+import json
+import os
+import re
+import time
+import zlib
+import numpy as np
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_PATH, "../../data")
+ALIASES_PATH = os.path.join(DATA_DIR, "chunk_aliases.json")
+
+# Mersenne prime used for the universal hash functions, every hash value fits in 31 bits
+PRIME = (1 << 31) - 1
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def shingles(text: str, size: int = 3) -> np.ndarray:
+    """
+    Hashes of the overlapping word `size`-grams of the lowercased text, so whitespace and punctuation differences are ignored
+    """
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    if len(tokens) < size:
+        grams = [" ".join(tokens)]
+    else:
+        grams = [" ".join(tokens[i : i + size]) for i in range(len(tokens) - size + 1)]
+    return np.array([zlib.crc32(gram.encode()) for gram in set(grams)], dtype=np.uint64)
+
+
+class NearDuplicateIndex:
+    """
+    Streaming near-duplicate detection with MinHash signatures and LSH banding. Each passage is compared only against the
+    canonical passages that share at least one band with it and is treated as a duplicate if their estimated Jaccard similarity
+    is at least `threshold`. Only the signatures and band buckets of canonical passages are kept, never their text.
+
+    `aliases` maps the chunk_id of every passage that was collapsed to the chunk_id of the passage it was collapsed into.
+
+    Memory grows linearly with the number of canonical passages, about 3.5KB each with the defaults (the signature plus one
+    bucket entry per band), so ~3.5GB for 1M unique passages. Deduplicate larger corpora in shards or with fewer `num_perm`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle_size: int = 3,
+        seed: int = 0,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, num_perm, dtype=np.uint64)
+        self.buckets: list[dict[bytes, list[int]]] = [{} for _ in range(bands)]
+        self.signatures: list[np.ndarray] = []
+        self.chunk_ids: list[str] = []
+        self.aliases: dict[str, str] = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingles(text, self.shingle_size)
+        return (
+            ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % PRIME)
+            .min(axis=1)
+            .astype(np.uint32)
+        )
+
+    def _band_keys(self, signature: np.ndarray) -> list[bytes]:
+        return [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+
+    def add(self, chunk_id: str, text: str) -> str:
+        """
+        Returns the canonical chunk_id for this passage, which is `chunk_id` itself unless it's a near duplicate of a passage we
+        have already seen
+        """
+        if chunk_id in self.aliases:
+            return self.aliases[chunk_id]
+
+        signature = self.signature(text)
+        keys = self._band_keys(signature)
+        candidates = {
+            idx
+            for band, key in enumerate(keys)
+            for idx in self.buckets[band].get(key, [])
+        }
+        for idx in sorted(candidates):
+            if np.mean(self.signatures[idx] == signature) >= self.threshold:
+                canonical = self.chunk_ids[idx]
+                if canonical != chunk_id:
+                    self.aliases[chunk_id] = canonical
+                return canonical
+
+        idx = len(self.chunk_ids)
+        self.signatures.append(signature)
+        self.chunk_ids.append(chunk_id)
+        for band, key in enumerate(keys):
+            self.buckets[band].setdefault(key, []).append(idx)
+        return chunk_id
+
+    def stats(self) -> dict[str, float]:
+        total = len(self.chunk_ids) + len(self.aliases)
+        return {
+            "passages": total,
+            "canonical": len(self.chunk_ids),
+            "duplicates": len(self.aliases),
+            "reduction": len(self.aliases) / total if total else 0,
+        }
+
+
+def dedup_passages(passages: Iterable[dict], index: NearDuplicateIndex):
+    """
+    Yields only the canonical passages, the chunk_ids of the ones that were dropped are recorded in `index.aliases`
+    """
+    for passage in passages:
+        if index.add(passage["chunk_id"], passage["text"]) == passage["chunk_id"]:
+            yield passage
+
+
+def save_aliases(aliases: dict[str, str], path: str = ALIASES_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(aliases, f)
+
+
+def load_aliases(path: str = ALIASES_PATH) -> dict[str, str]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def resolve_chunk_ids(chunk_ids: str | list[str], aliases: dict[str, str]):
+    """
+    Points labels that reference a collapsed duplicate at its canonical chunk_id instead. The single label files store a single
+    chunk id rather than a list so both are accepted.
+    """
+    if isinstance(chunk_ids, str):
+        return aliases.get(chunk_ids, chunk_ids)
+    return list(
+        dict.fromkeys(aliases.get(chunk_id, chunk_id) for chunk_id in chunk_ids)
+    )
+
+
+def resolve_query_items(
+    queries: list[QueryItem], aliases: dict[str, str]
+) -> list[QueryItem]:
+    return [
+        QueryItem(
+            query=query.query,
+            selected_chunk_ids=resolve_chunk_ids(query.selected_chunk_ids, aliases),
+        )
+        for query in queries
+    ]
+
+
+def _time_search(search, repeats: int = 3) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        search()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure_reduction(
+    passages: list[dict],
+    queries: list[str],
+    top_k: int = 25,
+    dim: int = 1536,
+    **kwargs,
+):
+    """
+    Compares the corpus before and after collapsing near duplicates: the number of rows, the size of the float32 vectors and
+    how long a BM25 and an exact vector scan over every query take. The vectors come from the offline
+    `lib.providers.LocalHashingEmbedder` since only the number of rows matters for the timing.
+    """
+    from lib.bm25 import BM25Index
+    from lib.providers import LocalHashingEmbedder
+
+    index = NearDuplicateIndex(**kwargs)
+    deduped = list(dedup_passages(tqdm(passages, desc="Deduplicating"), index))
+    embedder = LocalHashingEmbedder(dim)
+    query_vectors = np.array(embedder.embed(queries))
+
+    report = {"stats": index.stats()}
+    for name, corpus in [("original", passages), ("deduplicated", deduped)]:
+        bm25 = BM25Index.build(
+            [passage["text"] for passage in corpus],
+            [passage["chunk_id"] for passage in corpus],
+        )
+        vectors = np.array(
+            embedder.embed([passage["text"] for passage in corpus]), dtype=np.float32
+        )
+
+        def vector_scan():
+            distances = -(query_vectors @ vectors.T)
+            np.argpartition(distances, min(top_k, len(corpus) - 1), axis=1)
+
+        report[name] = {
+            "rows": len(corpus),
+            "vector_mb": vectors.nbytes / 1024**2,
+            "fts_ms": _time_search(lambda: bm25.search_batch(queries, top_k)) * 1000,
+            "vector_ms": _time_search(vector_scan) * 1000,
+        }
+    return report
+
+
+def main():
+    from lib.data import get_dataset, get_labels, stream_passages
+
+    parser = argparse.ArgumentParser(
+        description="Measure how much near duplicate removal shrinks the MS Marco index and speeds up search"
+    )
+    parser.add_argument("--n", type=int, default=1000)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument(
+        "--queries", default=os.path.join(DATA_DIR, "queries_single_label.jsonl")
+    )
+    parser.add_argument("--top-k", type=int, default=25)
+    args = parser.parse_args()
+
+    labels = []
+    passages = list(stream_passages(get_dataset(args.n), labels))
+    queries = (
+        [item["query"] for item in get_labels(args.queries)]
+        if os.path.exists(args.queries)
+        else [label["query"] for label in labels]
+    )
+    report = measure_reduction(passages, queries, args.top_k, threshold=args.threshold)
+
+    stats = report["stats"]
+    print(
+        f"Collapsed {stats['duplicates']} of {stats['passages']} passages ({stats['reduction']:.1%}) into near duplicates"
+    )
+    for name in ["original", "deduplicated"]:
+        result = report[name]
+        print(
+            f"{name:>12}: {result['rows']} rows, {result['vector_mb']:.1f}MB of vectors, "
+            f"fts {result['fts_ms']:.1f}ms, vector scan {result['vector_ms']:.1f}ms for {len(queries)} queries"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable
+
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    "RAG_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../.cache"),
+)
+DEFAULT_CACHE_PATH = os.path.join(CACHE_DIR, "embeddings.sqlite")
+# Once the cache is full we evict down to this fraction of `max_entries` so it only needs evicting again after that many inserts
+EVICT_TO = 0.9
+
+
+class EmbeddingCache:
+    """
+    This is an on-disk cache of embeddings keyed by (model name, dimensions, md5 of the text). Vectors are stored as raw float32 bytes
+    in SQLite and the least recently used entries are evicted once we go over `max_entries`.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 1_000_000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        (self._count,) = self._conn.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, dimensions: int | None, text: str) -> str:
+        # Same md5 scheme as the chunk_id in lib.data so keys line up with our passages
+        return f"{model}:{dimensions}:{hashlib.md5(text.encode()).hexdigest()}"
+
+    def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time_ns()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: dict[str, np.ndarray]):
+        now = time.time_ns()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for key, vector in items.items()
+                ],
+            )
+            self._count += len(items)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # `_count` also counts keys that were replaced rather than added, so we only count the rows once it says we're full
+        if self._count <= self.max_entries:
+            return
+        (self._count,) = self._conn.execute(
+            "SELECT COUNT(*) FROM embeddings"
+        ).fetchone()
+        if self._count <= self.max_entries:
+            return
+        target = int(self.max_entries * EVICT_TO)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (self._count - target,),
+        )
+        self._count = target
+
+    def _lookup(self, model: str, dimensions: int | None, texts: list[str]):
+        keys = [self.make_key(model, dimensions, text) for text in texts]
+        found = self.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        self.hits += len(keys) - sum(1 for key in keys if key in missing)
+        self.misses += len(missing)
+        return keys, found, missing
+
+    def _store(self, found, missing, vectors):
+        computed = {
+            key: np.asarray(vector, dtype=np.float32)
+            for key, vector in zip(missing.keys(), vectors)
+        }
+        self.put_many(computed)
+        found.update(computed)
+
+    def get_or_compute(
+        self,
+        model: str,
+        dimensions: int | None,
+        texts: list[str],
+        compute_fn: Callable[[list[str]], list[list[float]]],
+    ) -> list[np.ndarray]:
+        keys, found, missing = self._lookup(model, dimensions, texts)
+        if missing:
+            self._store(found, missing, compute_fn(list(missing.values())))
+        return [found[key] for key in keys]
+
+    async def aget_or_compute(
+        self,
+        model: str,
+        dimensions: int | None,
+        texts: list[str],
+        compute_fn: Callable[[list[str]], Awaitable[list[list[float]]]],
+    ) -> list[np.ndarray]:
+        keys, found, missing = self._lookup(model, dimensions, texts)
+        if missing:
+            self._store(found, missing, await compute_fn(list(missing.values())))
+        return [found[key] for key in keys]
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "entries": count,
+        }
+
+
+_cache: EmbeddingCache | None = None
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache()
+    return _cache
+
+
+def set_embedding_cache(cache: EmbeddingCache | None) -> EmbeddingCache | None:
+    global _cache
+    previous, _cache = _cache, cache
+    return previous
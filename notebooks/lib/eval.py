@@ -1,5 +1,6 @@
 from itertools import product
 from typing import Callable
+import numpy as np
 
 SIZES = [3, 5, 10, 15, 25]
 
@@ -41,3 +42,180 @@ def score_retrieval(
         )
         for fn_name, size in product(scoring_fns.keys(), sizes)
     }
+
+
+def build_hit_matrix(preds: list[list[str]], labels: list[str | list[str]], k: int):
+    """
+    Encodes a whole run as integer arrays and returns a boolean (n_queries, k) matrix marking which retrieved items are relevant,
+    a matrix marking later copies of a relevant item that was already retrieved, the number of relevant items and the number of
+    retrieved items for each query.
+
+    Only the first copy of a chunk counts as a hit, like `calculate_recall` and `calculate_reciprocal_rank`. Re-ingested tables
+    can return the same chunk more than once.
+    """
+    labels = [[label] if isinstance(label, str) else label for label in labels]
+    vocab = {}
+    for row in labels:
+        for label in row:
+            vocab.setdefault(label, len(vocab))
+
+    n_labels = max((len(row) for row in labels), default=0)
+    label_ids = np.full((len(labels), max(n_labels, 1)), -2, dtype=np.int64)
+    for i, row in enumerate(labels):
+        label_ids[i, : len(row)] = [vocab[label] for label in row]
+
+    # Predictions that never appear as a label can never be a hit so they all share the id -1
+    pred_ids = np.full((len(preds), k), -3, dtype=np.int64)
+    for i, row in enumerate(preds):
+        row = row[:k]
+        pred_ids[i, : len(row)] = [vocab.get(pred, -1) for pred in row]
+
+    relevant = (pred_ids[:, :, None] == label_ids[:, None, :]).any(axis=2)
+    # A stable sort puts the copies of an id next to each other in rank order, so every copy but the first follows its own id
+    order = np.argsort(pred_ids, axis=1, kind="stable")
+    sorted_ids = np.take_along_axis(pred_ids, order, axis=1)
+    repeated = np.zeros_like(relevant)
+    np.put_along_axis(
+        repeated,
+        order[:, 1:],
+        sorted_ids[:, 1:] == sorted_ids[:, :-1],
+        axis=1,
+    )
+
+    hits = relevant & ~repeated
+    n_relevant = np.array([len(set(row)) for row in labels])
+    n_retrieved = np.array([min(len(row), k) for row in preds])
+    return hits, relevant & repeated, n_relevant, n_retrieved
+
+
+def score_retrieval_batch(
+    preds: list[list[str]],
+    labels: list[str | list[str]],
+    sizes: list[int] = SIZES,
+) -> dict[str, np.ndarray]:
+    """
+    Vectorised version of `score_retrieval` over an entire run. Returns the per query recall, precision, mrr, ndcg and map at
+    every size as unrounded arrays so they can be averaged or bootstrapped.
+    """
+    max_k = max(sizes)
+    hits, repeated_hits, n_relevant, n_retrieved = build_hit_matrix(
+        preds, labels, max_k
+    )
+    ranks = np.arange(1, max_k + 1)
+
+    cumulative_hits = hits.cumsum(axis=1)
+    # `calculate_precision` counts every relevant prediction, including repeats of the same chunk
+    cumulative_relevant = (hits | repeated_hits).cumsum(axis=1)
+    first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1), max_k)
+    discounts = 1 / np.log2(ranks + 1)
+    dcg = (hits * discounts).cumsum(axis=1)
+    ideal_dcg = np.concatenate([[0], discounts.cumsum()])
+    precision_at_hit = (cumulative_hits / ranks) * hits
+    average_precision = precision_at_hit.cumsum(axis=1)
+
+    scores = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for size in sizes:
+            hits_at_k = cumulative_hits[:, size - 1]
+            n_ideal = np.minimum(n_relevant, size)
+            scores[f"recall@{size}"] = np.where(
+                n_relevant > 0, hits_at_k / n_relevant, 0
+            )
+            relevant_at_k = cumulative_relevant[:, size - 1]
+            scores[f"precision@{size}"] = np.where(
+                relevant_at_k > 0, relevant_at_k / np.minimum(n_retrieved, size), 0
+            )
+            scores[f"mrr@{size}"] = np.where(first_hit < size, 1 / (first_hit + 1), 0)
+            scores[f"ndcg@{size}"] = np.where(
+                n_ideal > 0, dcg[:, size - 1] / ideal_dcg[n_ideal], 0
+            )
+            scores[f"map@{size}"] = np.where(
+                n_ideal > 0, average_precision[:, size - 1] / n_ideal, 0
+            )
+    return scores
+
+
+def bootstrap_confidence_intervals(
+    scores: dict[str, np.ndarray],
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 0,
+):
+    """
+    Computes the mean of each metric along with a percentile bootstrap confidence interval over queries
+    """
+    rng = np.random.default_rng(seed)
+    metrics = list(scores.keys())
+    values = np.stack([scores[metric] for metric in metrics], axis=1)
+    n_queries = values.shape[0]
+
+    # Each resample is reduced to how many times it drew every query, so its means are `counts @ values / n_queries` and we
+    # never gather a (resamples, queries, metrics) array. Resampling in blocks keeps the counts to ~2M entries at a time.
+    block = max(1, 2_000_000 // max(n_queries, 1))
+    means = []
+    for start in range(0, n_resamples, block):
+        size = min(block, n_resamples - start)
+        idx = rng.integers(0, n_queries, (size, n_queries))
+        idx += np.arange(size)[:, None] * n_queries
+        counts = np.bincount(idx.ravel(), minlength=size * n_queries).reshape(
+            size, n_queries
+        )
+        means.append(counts @ values / n_queries)
+    means = np.concatenate(means)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha], axis=0)
+    return {
+        metric: {
+            "mean": float(values[:, i].mean()),
+            "low": float(low[i]),
+            "high": float(high[i]),
+        }
+        for i, metric in enumerate(metrics)
+    }
+
+
+def check_batch_scoring(
+    preds: list[list[str]], labels: list[str | list[str]], sizes: list[int] = SIZES
+):
+    """
+    Raises if `score_retrieval_batch` disagrees with `score_retrieval` on recall, precision or mrr for any query
+    """
+    scoring_fns = {
+        "recall": calculate_recall,
+        "precision": calculate_precision,
+        "mrr": calculate_reciprocal_rank,
+    }
+    batch = score_retrieval_batch(preds, labels, sizes)
+    for i, (pred, label) in enumerate(zip(preds, labels)):
+        for metric, expected in score_retrieval(
+            pred, label, sizes, scoring_fns
+        ).items():
+            if abs(batch[metric][i] - expected) > 1e-3:
+                raise AssertionError(
+                    f"{metric} for query {i} is {batch[metric][i]:.3f}, score_retrieval gives {expected}"
+                )
+
+
+def main():
+    # Regression cases for the vectorised scorer, including runs that retrieve the same chunk more than once
+    preds = [
+        ["a", "a", "b"],
+        ["b", "a", "a", "c", "a"],
+        ["x", "y", "z"],
+        ["c", "c", "c", "c", "c", "d"],
+        [],
+        ["a", "b", "c", "d", "e", "f"],
+    ]
+    labels = ["a", ["a", "c"], "a", ["c", "d"], "a", ["f", "b"]]
+    check_batch_scoring(preds, labels, [1, 3, 5])
+
+    scores = score_retrieval_batch([["a", "a", "b"]], ["a"], [3])
+    for metric in ["recall@3", "mrr@3", "ndcg@3", "map@3"]:
+        if scores[metric][0] != 1:
+            raise AssertionError(f"{metric} counts the repeated chunk more than once")
+    print("score_retrieval_batch matches score_retrieval")
+
+
+if __name__ == "__main__":
+    main()
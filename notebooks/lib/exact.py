@@ -0,0 +1,246 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+from lancedb.table import Table
+from tqdm import tqdm
+from lib.embedding_cache import CACHE_DIR
+from lib.models import QueryItem
+from lib.openai_helpers import generate_embeddings
+from lib.tracing import traced_search
+import os
+import numpy as np
+
+EXACT_DIR = os.path.join(CACHE_DIR, "exact")
+
+
+class ExactIndex:
+    """
+    Brute force nearest neighbour search over a memory mapped copy of a table's vector column. Rows are scanned in blocks so
+    memory stays bounded at roughly `block_size` rows per worker, and blocks are scored in parallel since numpy releases the
+    GIL inside the matmul.
+
+    Distances match Lance, squared euclidean for L2 and 1 - cosine similarity for cosine.
+    """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        norms: np.ndarray,
+        chunk_ids: np.ndarray,
+        metric: Literal["L2", "cosine"] = "L2",
+    ):
+        self.vectors = vectors
+        self.norms = norms
+        self.chunk_ids = chunk_ids
+        self.metric = metric
+
+    @classmethod
+    def export(
+        cls,
+        table: Table,
+        path: str,
+        dtype=np.float32,
+        metric: Literal["L2", "cosine"] = "L2",
+        batch_size: int = 10_000,
+    ) -> "ExactIndex":
+        os.makedirs(path, exist_ok=True)
+        n_rows = table.count_rows()
+        dim = table.schema.field("vector").type.list_size
+        vectors = np.lib.format.open_memmap(
+            os.path.join(path, "vectors.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(n_rows, dim),
+        )
+        norms = np.empty(n_rows, dtype=np.float32)
+        chunk_ids = []
+
+        offset = 0
+        batches = table.to_lance().to_batches(
+            columns=["chunk_id", "vector"], batch_size=batch_size
+        )
+        with tqdm(total=n_rows, desc=f"Exporting vectors from {table.name}") as pbar:
+            for batch in batches:
+                block = (
+                    batch["vector"]
+                    .values.to_numpy()
+                    .reshape(-1, dim)
+                    .astype(np.float32, copy=False)
+                )
+                if metric == "cosine":
+                    block = block / np.linalg.norm(block, axis=1, keepdims=True)
+                vectors[offset : offset + len(block)] = block
+                # Norms are taken after the cast so distances are consistent with the stored vectors
+                stored = vectors[offset : offset + len(block)].astype(np.float32)
+                norms[offset : offset + len(block)] = np.einsum(
+                    "ij,ij->i", stored, stored
+                )
+                chunk_ids.extend(batch["chunk_id"].to_pylist())
+                offset += len(block)
+                pbar.update(len(block))
+
+        vectors.flush()
+        np.save(os.path.join(path, "norms.npy"), norms)
+        np.save(os.path.join(path, "chunk_ids.npy"), np.array(chunk_ids, dtype=str))
+        with open(os.path.join(path, "metric"), "w") as f:
+            f.write(metric)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str) -> "ExactIndex":
+        with open(os.path.join(path, "metric")) as f:
+            metric = f.read()
+        return cls(
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "norms.npy")),
+            np.load(os.path.join(path, "chunk_ids.npy")).astype(object),
+            metric,
+        )
+
+    def _search_block(
+        self,
+        queries: np.ndarray,
+        query_norms: np.ndarray,
+        start: int,
+        stop: int,
+        top_k: int,
+    ):
+        block = np.asarray(self.vectors[start:stop], dtype=np.float32)
+        if self.metric == "cosine":
+            distances = 1 - queries @ block.T
+        else:
+            distances = (
+                query_norms[:, None]
+                - 2 * queries @ block.T
+                + self.norms[None, start:stop]
+            )
+        k = min(top_k, len(block))
+        indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(distances, indices, axis=1), indices + start
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        block_size: int = 16_384,
+        max_workers: int = 4,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the (distances, row indices) of the top_k rows for each query, sorted closest first
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.metric == "cosine":
+            queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            blocks = list(
+                executor.map(
+                    lambda start: self._search_block(
+                        queries, query_norms, start, start + block_size, top_k
+                    ),
+                    range(0, len(self.vectors), block_size),
+                )
+            )
+
+        distances = np.concatenate([block[0] for block in blocks], axis=1)
+        indices = np.concatenate([block[1] for block in blocks], axis=1)
+        k = min(top_k, distances.shape[1])
+        keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, keep, axis=1)
+        indices = np.take_along_axis(indices, keep, axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")
+        return (
+            np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(indices, order, axis=1),
+        )
+
+    def search_batch(
+        self, queries: np.ndarray, top_k: int, query_batch_size: int = 256, **kwargs
+    ):
+        results = []
+        for start in range(0, len(queries), query_batch_size):
+            distances, indices = self.search(
+                queries[start : start + query_batch_size], top_k, **kwargs
+            )
+            for row_distances, row_indices in zip(distances, indices):
+                results.append(
+                    [
+                        {"chunk_id": chunk_id, "_distance": float(distance)}
+                        for chunk_id, distance in zip(
+                            self.chunk_ids[row_indices], row_distances
+                        )
+                    ]
+                )
+        return results
+
+
+_indexes: dict[tuple, ExactIndex] = {}
+
+
+def _cache_index(key: tuple, index: ExactIndex):
+    # Drop the indexes of older table versions so the cache doesn't grow with every write to the table
+    for stale in [
+        other
+        for other in _indexes
+        if other[0] == key[0] and other[2:] == key[2:] and other[1] < key[1]
+    ]:
+        del _indexes[stale]
+    _indexes[key] = index
+
+
+def get_exact_index(
+    table: Table,
+    dtype=np.float32,
+    metric: Literal["L2", "cosine"] = "L2",
+    rebuild: bool = False,
+) -> ExactIndex:
+    """
+    Loads the exported vectors for this table, exporting them again if the table has been written to since. The latest
+    loaded index of each table is kept in memory so that the chunk ids and norms are only read from disk once.
+    """
+    key = (table.name, table.version, np.dtype(dtype).name, metric)
+    if not rebuild and key in _indexes:
+        return _indexes[key]
+
+    path = os.path.join(EXACT_DIR, f"{table.name}-{np.dtype(dtype).name}-{metric}")
+    version_path = os.path.join(path, "version")
+    if not rebuild and os.path.exists(version_path):
+        with open(version_path) as f:
+            if f.read() == str(table.version):
+                index = ExactIndex.load(path)
+                _cache_index(key, index)
+                return index
+
+    index = ExactIndex.export(table, path, dtype, metric)
+    with open(version_path, "w") as f:
+        f.write(str(table.version))
+    _cache_index(key, index)
+    return index
+
+
+@traced_search
+def exact_vector_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    batch_size: int = 20,
+    embedded_queries=None,
+):
+    """
+    Same results as `vector_search` without an ANN index, rows are `chunk_id` and `_distance` only
+    """
+    if embedded_queries is None:
+        embedded_queries = generate_embeddings(queries, batch_size)
+    return get_exact_index(table).search_batch(np.array(embedded_queries), top_k)
+
+
+def exact_neighbours(table: Table, embedded_queries, top_k: int) -> list[list[str]]:
+    """
+    True nearest neighbour chunk ids for each query, used as labels when measuring the recall lost to the ANN index
+    """
+    return [
+        [item["chunk_id"] for item in items]
+        for items in get_exact_index(table).search_batch(
+            np.array(embedded_queries), top_k
+        )
+    ]
@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+from lancedb.table import Table
+from tqdm import tqdm
+from lib.models import QueryItem
+from lib.openai_helpers import generate_embeddings
+from lib.string_helpers import strip_punctuation
+from lib.tracing import traced_search
+import numpy as np
+
+
+class Legs:
+    """
+    The raw results of the full text and vector search for a single query. These can be fused any number of times without
+    searching again.
+    """
+
+    __slots__ = ["fts_ids", "fts_scores", "vector_ids", "vector_distances"]
+
+    def __init__(self, fts_ids, fts_scores, vector_ids, vector_distances):
+        self.fts_ids = fts_ids
+        self.fts_scores = fts_scores
+        self.vector_ids = vector_ids
+        self.vector_distances = vector_distances
+
+
+def _column(results, names: list[str]) -> np.ndarray:
+    for name in names:
+        if name in results.column_names:
+            return results[name].to_numpy()
+    raise ValueError(f"None of the columns {names} are in the search results")
+
+
+def search_legs(
+    table: Table,
+    queries: list[QueryItem],
+    fts_k: int = 50,
+    vector_k: int = 50,
+    embedded_queries=None,
+    batch_size: int = 20,
+    max_workers: int = 8,
+) -> list[Legs]:
+    """
+    Runs the tantivy full text search and the vector search for every query concurrently. Only the chunk_id and score columns
+    are read back so that we never copy vectors out of Lance.
+    """
+    if embedded_queries is None:
+        embedded_queries = generate_embeddings(queries, batch_size)
+
+    def fts_leg(query: QueryItem):
+        results = (
+            table.search(strip_punctuation(query.query), query_type="fts")
+            .select(["chunk_id"])
+            .limit(fts_k)
+            .to_arrow()
+        )
+        if results.num_rows == 0:
+            # Tantivy returns a table with only a score column when nothing matches
+            return [], np.zeros(0, dtype=np.float32)
+        return results["chunk_id"].to_pylist(), _column(results, ["_score", "score"])
+
+    def vector_leg(embedding):
+        results = (
+            table.search(embedding, query_type="vector")
+            .select(["chunk_id"])
+            .limit(vector_k)
+            .to_arrow()
+        )
+        if results.num_rows == 0:
+            return [], np.zeros(0, dtype=np.float32)
+        return results["chunk_id"].to_pylist(), _column(results, ["_distance"])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fts_futures = [executor.submit(fts_leg, query) for query in queries]
+        vector_futures = [
+            executor.submit(vector_leg, embedding) for embedding in embedded_queries
+        ]
+        return [
+            Legs(*fts_future.result(), *vector_future.result())
+            for fts_future, vector_future in tqdm(
+                zip(fts_futures, vector_futures),
+                total=len(queries),
+                desc="Executing FTS and Vector legs...",
+            )
+        ]
+
+
+def _min_max(values: np.ndarray, higher_is_better: bool = True) -> np.ndarray:
+    """
+    Scales a leg's scores to [0, 1] with 1 for its best result. Distances are passed with `higher_is_better=False`, and when
+    every result in a leg is tied (or there is only one) they all count as the best result.
+    """
+    if len(values) == 0:
+        return values.astype(np.float64)
+    spread = values.max() - values.min()
+    if spread == 0:
+        return np.ones_like(values, dtype=np.float64)
+    if higher_is_better:
+        return (values - values.min()) / spread
+    return (values.max() - values) / spread
+
+
+def _top_k(ids: np.ndarray, scores: np.ndarray, top_k: int):
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [
+        {"chunk_id": chunk_id, "_relevance_score": float(score)}
+        for chunk_id, score in zip(ids[order].tolist(), scores[order])
+    ]
+
+
+def fuse_rrf(legs: Legs, top_k: int, k: int = 60):
+    ids, inverse = np.unique(
+        np.array(legs.fts_ids + legs.vector_ids, dtype=object).astype(str),
+        return_inverse=True,
+    )
+    ranks = np.concatenate(
+        [np.arange(len(legs.fts_ids)), np.arange(len(legs.vector_ids))]
+    )
+    scores = np.bincount(inverse, weights=1 / (k + ranks + 1), minlength=len(ids))
+    return _top_k(ids, scores, top_k)
+
+
+def fuse_linear(legs: Legs, top_k: int, vector_search_weight: float = 0.7):
+    ids, inverse = np.unique(
+        np.array(legs.fts_ids + legs.vector_ids, dtype=object).astype(str),
+        return_inverse=True,
+    )
+    # Same convention as LinearCombinationReranker, a result missing from a leg gets a score of 0 from that leg
+    weights = np.concatenate(
+        [
+            (1 - vector_search_weight) * _min_max(legs.fts_scores),
+            vector_search_weight
+            * _min_max(legs.vector_distances, higher_is_better=False),
+        ]
+    )
+    scores = np.bincount(inverse, weights=weights, minlength=len(ids))
+    return _top_k(ids, scores, top_k)
+
+
+def fuse(
+    legs: list[Legs],
+    top_k: int,
+    method: Literal["rrf", "linear"] = "rrf",
+    **kwargs,
+):
+    fuse_fn = fuse_rrf if method == "rrf" else fuse_linear
+    return [fuse_fn(query_legs, top_k, **kwargs) for query_legs in legs]
+
+
+@traced_search
+def fusion_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    method: Literal["rrf", "linear"] = "rrf",
+    fts_k: int = 50,
+    vector_k: int = 50,
+    **kwargs,
+):
+    legs = search_legs(table, queries, fts_k=fts_k, vector_k=vector_k)
+    return fuse(legs, top_k, method, **kwargs)
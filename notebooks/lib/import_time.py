@@ -0,0 +1,99 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+NOTEBOOKS_PATH = os.path.join(BASE_PATH, "..")
+
+DEFAULT_MODULES = [
+    "lib.models",
+    "lib.providers",
+    "lib.openai_helpers",
+    "lib.llm",
+    "lib.eval",
+    "lib.data",
+    "lib.synthethic",
+    "lib.classify",
+]
+# SDKs that should only be imported once something actually needs them
+HEAVY_MODULES = ["openai", "instructor", "lancedb", "datasets", "sklearn", "cohere"]
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)")
+
+
+def measure_import(module: str) -> tuple[float, list[str]]:
+    """
+    Imports `module` in a fresh interpreter and returns its cumulative import time in ms along with the heavy SDKs it pulled in.
+    The API keys are removed from the environment so that nothing can rely on them being set at import time.
+    """
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ["OPENAI_API_KEY", "COHERE_API_KEY"]
+    }
+    script = (
+        f"import sys, {module}; "
+        f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        capture_output=True,
+        text=True,
+        cwd=NOTEBOOKS_PATH,
+        env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}:\n{result.stderr[-2000:]}")
+
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match and match.group(2) == module:
+            cumulative_us = int(match.group(1))
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative_us / 1000, loaded
+
+
+def benchmark_imports(modules: list[str], repeats: int = 5):
+    results = {}
+    for module in modules:
+        timings, loaded = [], []
+        for _ in range(repeats):
+            elapsed_ms, loaded = measure_import(module)
+            timings.append(elapsed_ms)
+        results[module] = {"ms": min(timings), "heavy_modules": loaded}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cold import time of the lib modules and the heavy SDKs they load"
+    )
+    parser.add_argument("--modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Exit with an error if any module takes longer than this to import",
+    )
+    args = parser.parse_args()
+
+    results = benchmark_imports(args.modules, args.repeats)
+    over_budget = []
+    for module, result in results.items():
+        print(
+            f"{module:>20}: {result['ms']:.1f}ms loads [{', '.join(result['heavy_modules'])}]"
+        )
+        if args.max_ms is not None and result["ms"] > args.max_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over the {args.max_ms}ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
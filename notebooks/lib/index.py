@@ -0,0 +1,191 @@
+from lancedb.table import Table
+from tqdm import tqdm
+from lib.data import load_query_items
+from lib.db import get_table
+from lib.embedding_cache import CACHE_DIR
+from lib.eval import score_retrieval_batch
+from lib.exact import exact_neighbours
+from lib.models import QueryItem
+from lib.openai_helpers import generate_embeddings
+import argparse
+import json
+import math
+import os
+import time
+import lancedb
+import numpy as np
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+LANCE_DIR_PATH = os.path.join(BASE_PATH, "../../lance")
+DATA_DIR = os.path.join(BASE_PATH, "../../data")
+VECTOR_SEARCH_CONFIG_PATH = os.path.join(CACHE_DIR, "vector_search_config.json")
+
+# PQ trains 256 centroids per sub vector so we need at least this many rows
+MIN_ROWS_FOR_INDEX = 256
+
+
+def create_vector_index(
+    table: Table,
+    num_partitions: int | None = None,
+    num_sub_vectors: int | None = None,
+    metric: str = "L2",
+):
+    """
+    Builds an IVF-PQ index on the vector column. By default we use ~sqrt(n) partitions and 16 dimensions per PQ sub vector.
+    """
+    n_rows = table.count_rows()
+    if n_rows < MIN_ROWS_FOR_INDEX:
+        print(f"Skipping vector index for {table.name}, it only has {n_rows} rows")
+        return None
+
+    dim = table.schema.field("vector").type.list_size
+    num_partitions = num_partitions or max(1, int(math.sqrt(n_rows)))
+    num_sub_vectors = num_sub_vectors or next(
+        size for size in [dim // 16, dim // 8, dim // 4, 1] if size and dim % size == 0
+    )
+    table.create_index(
+        metric=metric,
+        num_partitions=num_partitions,
+        num_sub_vectors=num_sub_vectors,
+        replace=True,
+    )
+    print(
+        f"Built IVF-PQ index on {table.name} with {num_partitions} partitions and {num_sub_vectors} sub vectors"
+    )
+    return {"num_partitions": num_partitions, "num_sub_vectors": num_sub_vectors}
+
+
+def load_vector_search_config(table_name: str) -> dict:
+    if not os.path.exists(VECTOR_SEARCH_CONFIG_PATH):
+        return {}
+    with open(VECTOR_SEARCH_CONFIG_PATH) as f:
+        return json.load(f).get(table_name, {})
+
+
+def save_vector_search_config(table_name: str, config: dict):
+    configs = {}
+    if os.path.exists(VECTOR_SEARCH_CONFIG_PATH):
+        with open(VECTOR_SEARCH_CONFIG_PATH) as f:
+            configs = json.load(f)
+    configs[table_name] = config
+    os.makedirs(os.path.dirname(VECTOR_SEARCH_CONFIG_PATH), exist_ok=True)
+    with open(VECTOR_SEARCH_CONFIG_PATH, "w") as f:
+        json.dump(configs, f, indent=2)
+
+
+def apply_vector_search_config(query, config: dict):
+    if config.get("nprobes"):
+        query = query.nprobes(config["nprobes"])
+    if config.get("refine_factor"):
+        query = query.refine_factor(config["refine_factor"])
+    return query
+
+
+def pareto_frontier(results: list[dict], recall_key: str):
+    frontier, best_recall = [], -1
+    for result in sorted(results, key=lambda result: result["mean_ms"]):
+        if result[recall_key] > best_recall:
+            frontier.append(result)
+            best_recall = result[recall_key]
+    return frontier
+
+
+def tune_vector_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int = 25,
+    target_recall: float = 0.9,
+    nprobes_grid: list[int] = [1, 5, 10, 20, 50, 100],
+    refine_grid: list[int | None] = [None, 1, 5, 10],
+    labels: list[list[str]] | None = None,
+):
+    """
+    Sweeps nprobes and refine_factor, measuring recall@top_k and latency per configuration. `labels` defaults to the selected
+    chunk ids of each query but can be swapped for exact nearest neighbours to measure the recall lost to the index alone.
+    """
+    embedded_queries = generate_embeddings(queries, 100)
+    labels = labels or [query.selected_chunk_ids for query in queries]
+    recall_key = f"recall@{top_k}"
+
+    results = []
+    for nprobes in nprobes_grid:
+        for refine_factor in refine_grid:
+            config = {"nprobes": nprobes, "refine_factor": refine_factor}
+            latencies, retrieved = [], []
+            for embedding in tqdm(embedded_queries, desc=f"Sweeping {config}"):
+                start = time.perf_counter()
+                items = (
+                    apply_vector_search_config(
+                        table.search(embedding, query_type="vector"), config
+                    )
+                    .select(["chunk_id"])
+                    .limit(top_k)
+                    .to_arrow()
+                )
+                latencies.append(time.perf_counter() - start)
+                retrieved.append(items["chunk_id"].to_pylist())
+
+            scores = score_retrieval_batch(retrieved, labels, [top_k])
+            results.append(
+                {
+                    **config,
+                    recall_key: float(scores[recall_key].mean()),
+                    "mean_ms": float(np.mean(latencies) * 1000),
+                    "p95_ms": float(np.percentile(latencies, 95) * 1000),
+                }
+            )
+
+    frontier = pareto_frontier(results, recall_key)
+    meets_target = [
+        result for result in frontier if result[recall_key] >= target_recall
+    ]
+    best = meets_target[0] if meets_target else frontier[-1]
+    return best, frontier, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the vector index for a table and tune nprobes/refine_factor against labelled recall"
+    )
+    parser.add_argument("--table", default="ms_marco")
+    parser.add_argument(
+        "--queries", default=os.path.join(DATA_DIR, "queries_single_label.jsonl")
+    )
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--top-k", type=int, default=25)
+    parser.add_argument("--target-recall", type=float, default=0.9)
+    parser.add_argument("--skip-build", action="store_true")
+    parser.add_argument(
+        "--exact-labels",
+        action="store_true",
+        help="Measure recall against exact nearest neighbours instead of the labelled chunks",
+    )
+    args = parser.parse_args()
+
+    db = lancedb.connect(LANCE_DIR_PATH)
+    table = get_table(db, args.table)
+    if not args.skip_build and create_vector_index(table) is None:
+        return
+
+    queries = load_query_items(args.queries, args.limit)
+    labels = None
+    if args.exact_labels:
+        labels = exact_neighbours(table, generate_embeddings(queries, 100), args.top_k)
+    best, frontier, _ = tune_vector_search(
+        table, queries, args.top_k, args.target_recall, labels=labels
+    )
+
+    print("Recall vs latency frontier")
+    for result in frontier:
+        print(
+            f"  nprobes={result['nprobes']:<4} refine_factor={str(result['refine_factor']):<5} "
+            f"recall@{args.top_k}={result[f'recall@{args.top_k}']:.3f} mean={result['mean_ms']:.2f}ms p95={result['p95_ms']:.2f}ms"
+        )
+
+    config = {"nprobes": best["nprobes"], "refine_factor": best["refine_factor"]}
+    save_vector_search_config(args.table, config)
+    print(f"Saved {config} as the default vector search config for {args.table}")
+
+
+if __name__ == "__main__":
+    main()
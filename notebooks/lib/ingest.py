@@ -0,0 +1,91 @@
+from itertools import islice
+from typing import Iterable
+from tqdm import tqdm
+from lib.openai_helpers import AdaptiveBackoff, embed_batch_async
+from lib.tracing import span
+import asyncio
+import numpy as np
+import pyarrow as pa
+
+_DONE = object()
+
+
+def to_record_batch(rows: list[dict], vectors, schema: pa.Schema) -> pa.RecordBatch:
+    columns = []
+    for field in schema:
+        if field.name == "vector":
+            flat = pa.array(np.asarray(vectors, dtype=np.float32).ravel())
+            columns.append(
+                pa.FixedSizeListArray.from_arrays(flat, field.type.list_size)
+            )
+        else:
+            columns.append(
+                pa.array([row.get(field.name) for row in rows], type=field.type)
+            )
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+async def stream_into_async_table(
+    table,
+    rows: Iterable[dict],
+    batch_size: int = 500,
+    max_pending_batches: int = 4,
+    max_in_flight: int = 4,
+):
+    """
+    Streams `rows` into an async Lance table. Reading from `rows`, embedding the `text` field and writing Arrow RecordBatches all
+    run concurrently and are connected by bounded queues, so at most a handful of batches are held in memory at any point.
+
+    The async client does not run the embedding function configured on the schema, so we embed the text ourselves here.
+    """
+    schema = await table.schema()
+    rows = iter(rows)
+    to_embed = asyncio.Queue(maxsize=max_pending_batches)
+    to_write = asyncio.Queue(maxsize=max_pending_batches)
+    sem = asyncio.Semaphore(max_in_flight)
+    backoff = AdaptiveBackoff()
+    progress = tqdm(desc="Inserting rows")
+
+    async def read():
+        while True:
+            # Pulling from a HF stream blocks on the network so we do it off the event loop
+            batch = await asyncio.to_thread(lambda: list(islice(rows, batch_size)))
+            if not batch:
+                break
+            await to_embed.put(batch)
+        for _ in range(max_in_flight):
+            await to_embed.put(_DONE)
+
+    async def embed():
+        while (batch := await to_embed.get()) is not _DONE:
+            vectors = await embed_batch_async(
+                [row["text"] for row in batch], sem, backoff
+            )
+            await to_write.put(to_record_batch(batch, vectors, schema))
+        await to_write.put(_DONE)
+
+    async def write():
+        remaining = max_in_flight
+        while remaining:
+            record_batch = await to_write.get()
+            if record_batch is _DONE:
+                remaining -= 1
+                continue
+            with span(
+                "lib.ingest.write_batch",
+                table=table.name,
+                batch_size=record_batch.num_rows,
+            ):
+                await table.add(pa.Table.from_batches([record_batch]))
+            progress.update(record_batch.num_rows)
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(read())
+            for _ in range(max_in_flight):
+                tg.create_task(embed())
+            tg.create_task(write())
+    finally:
+        progress.close()
+
+    return progress.n
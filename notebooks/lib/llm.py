@@ -0,0 +1,236 @@
+from pydantic import BaseModel
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from lib.embedding_cache import CACHE_DIR
+from lib.providers import get_provider
+from lib.tracing import span
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "llm_responses.sqlite")
+
+
+class TokenBucket:
+    """
+    Allows `rate_per_minute` units through per minute with bursts of up to `capacity` units
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    async def acquire(self, amount: float):
+        # Requests larger than the bucket would wait forever so we cap them at the capacity
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount: float):
+        # Used to correct an estimate once we know the real usage, this can push the bucket into debt
+        self._refill()
+        self.tokens -= amount
+
+
+class ResponseCache:
+    def __init__(self, path: str = DEFAULT_RESPONSE_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, response: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)",
+                (key, response),
+            )
+            self._conn.commit()
+
+
+class LLMGateway:
+    """
+    This is the single entry point for every structured LLM call in `lib`. All calls share one requests and tokens per minute
+    budget, identical requests that are already in flight are coalesced into a single call and responses are cached on disk
+    keyed by (model, messages, response_model schema).
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 200_000,
+        cache: ResponseCache | None = None,
+        use_cache: bool = True,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.cache = cache if cache is not None or not use_cache else ResponseCache()
+        self._client = None
+        self.stats = {
+            "calls": 0,
+            "cache_hits": 0,
+            "coalesced": 0,
+            "rate_limited": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "latency": 0.0,
+        }
+        self._loop = None
+
+    @property
+    def client(self):
+        # Created on the first call so that importing anything that uses the gateway doesn't need openai or an API key
+        if self._client is None:
+            self._client = get_provider("llm")
+        return self._client
+
+    def _ensure_loop(self):
+        # asyncio primitives are bound to the loop they are first used on and setup.py runs several loops one after another
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._requests = TokenBucket(self.requests_per_minute)
+            self._tokens = TokenBucket(self.tokens_per_minute)
+            self._in_flight: dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def make_key(model: str, messages: list[dict], response_model: type[BaseModel]):
+        payload = json.dumps(
+            {
+                "model": model,
+                "messages": messages,
+                "schema": response_model.model_json_schema(),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def _call(self, model, messages, response_model, max_retries, **kwargs):
+        estimated_tokens = (
+            sum(len(str(message["content"])) for message in messages) // 4
+        )
+        with span(
+            "lib.llm.create", model=model, response_model=response_model.__name__
+        ) as current:
+            await self._requests.acquire(1)
+            await self._tokens.acquire(estimated_tokens)
+            response, completion = await self._complete(
+                model, messages, response_model, max_retries, **kwargs
+            )
+            if completion.usage:
+                current.set_attribute("prompt_tokens", completion.usage.prompt_tokens)
+                current.set_attribute(
+                    "completion_tokens", completion.usage.completion_tokens
+                )
+
+        self.stats["calls"] += 1
+        if completion.usage:
+            self.stats["prompt_tokens"] += completion.usage.prompt_tokens
+            self.stats["completion_tokens"] += completion.usage.completion_tokens
+            self._tokens.adjust(completion.usage.total_tokens - estimated_tokens)
+        return response
+
+    async def _complete(self, model, messages, response_model, max_retries, **kwargs):
+        from openai import RateLimitError, APITimeoutError, APIConnectionError
+
+        async for attempt in AsyncRetrying(
+            wait=wait_random_exponential(multiplier=1, min=10, max=90),
+            stop=stop_after_attempt(3),
+            retry=retry_if_exception_type(
+                (RateLimitError, APITimeoutError, APIConnectionError)
+            ),
+            reraise=True,
+        ):
+            with attempt:
+                start = time.perf_counter()
+                try:
+                    response, completion = (
+                        await self.client.chat.completions.create_with_completion(
+                            model=model,
+                            messages=messages,
+                            response_model=response_model,
+                            max_retries=max_retries,
+                            **kwargs,
+                        )
+                    )
+                except RateLimitError:
+                    self.stats["rate_limited"] += 1
+                    raise
+                finally:
+                    self.stats["latency"] += time.perf_counter() - start
+        return response, completion
+
+    async def create(
+        self,
+        model: str,
+        messages: list[dict],
+        response_model: type[BaseModel],
+        max_retries: int = 3,
+        **kwargs,
+    ):
+        self._ensure_loop()
+        key = self.make_key(model, messages, response_model)
+
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                return response_model.model_validate_json(cached)
+
+        if key in self._in_flight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self._in_flight[key])
+
+        task = asyncio.create_task(
+            self._call(model, messages, response_model, max_retries, **kwargs)
+        )
+        self._in_flight[key] = task
+        try:
+            response = await asyncio.shield(task)
+            if self.cache is not None:
+                self.cache.put(key, response.model_dump_json())
+            return response
+        finally:
+            self._in_flight.pop(key, None)
+
+
+_gateway: LLMGateway | None = None
+
+
+def get_gateway() -> LLMGateway:
+    global _gateway
+    if _gateway is None:
+        _gateway = LLMGateway()
+    return _gateway
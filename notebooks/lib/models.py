@@ -1,43 +1,28 @@
-from lancedb.pydantic import LanceModel, Vector
-from lancedb.embeddings import get_registry
 from typing import Literal
-from pydantic import Field
+from pydantic import BaseModel, Field
 
-func = get_registry().get("openai").create(name="text-embedding-3-small")
+# The Lance schemas need lancedb and create an embedding function, so they live in `lib.schemas` and are only imported the
+# first time one of them is used
+_SCHEMAS = {
+    "CachedOpenAIEmbeddings",
+    "LocalHashingEmbeddings",
+    "func",
+    "EmbeddedPassage",
+    "EmbeddedPassageWithQA",
+    "EmbeddedPassageWithMetadata",
+    "ArxivPaper",
+}
 
 
-class EmbeddedPassage(LanceModel):
-    vector: Vector(dim=func.ndims()) = func.VectorField()  # type: ignore
-    chunk_id: str
-    text: str = func.SourceField()
+def __getattr__(name: str):
+    if name in _SCHEMAS:
+        import lib.schemas
 
+        return getattr(lib.schemas, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-class EmbeddedPassageWithQA(LanceModel):
-    vector: Vector(func.ndims()) = func.VectorField()
-    chunk_id: str
-    text: str = func.SourceField()
-    source_text: str
 
-
-class EmbeddedPassageWithMetadata(LanceModel):
-    vector: Vector(func.ndims()) = func.VectorField()
-    chunk_id: str
-    text: str = func.SourceField()
-    keywords: str
-    search_queries: str
-
-
-class ArxivPaper(LanceModel):
-    title: str
-    authors: str
-    category: str
-    abstract: str
-    text: str = func.SourceField()
-    vector: Vector(func.ndims()) = func.VectorField(default=None)
-    chunk_id: str
-
-
-class QueryItem(LanceModel):
+class QueryItem(BaseModel):
     """
     This is a Pydantic class representing a single MS-Marco query and it's corresponding chunk(s) that we should be retrieving when working with the MS-Marco dataset.
     """
@@ -46,7 +31,7 @@ class QueryItem(LanceModel):
     selected_chunk_ids: list[str]
 
 
-class Capability(LanceModel):
+class Capability(BaseModel):
     """
     This is a model representing an evaluation of the required capabilities to execute a task.
 
@@ -69,7 +54,7 @@ class Capability(LanceModel):
     )
 
 
-class QueryTagger(LanceModel):
+class QueryTagger(BaseModel):
     capabilities: list[str]
     topic_model: int
     query: str
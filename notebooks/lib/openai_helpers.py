@@ -1,27 +1,163 @@
 from itertools import batched
-from openai import Client
+from collections import deque
+from typing import AsyncIterator
 from tqdm import tqdm
 from lib.models import QueryItem
+from lib.embedding_cache import get_embedding_cache
+from lib.providers import get_embedder
+from lib.timing import record_stage
+from lib.tracing import span
+import asyncio
+import random
 
-client = Client()
+# The embeddings endpoint accepts at most 2048 inputs per request
+MAX_INPUTS_PER_REQUEST = 2048
 
 
-def generate_embeddings(data: list[QueryItem], batch_size):
-    batches = batched(data, batch_size)
+def embed_texts(texts: list[str], batch_size):
+    batches = batched(texts, batch_size)
+    embedder = get_embedder()
 
-    def generate_embeddings_batch(batch):
-        res = client.embeddings.create(
-            model="text-embedding-3-small", input=[item.query for item in list(batch)]
-        )
-        return res.data
-
-    batched_embeddings = [generate_embeddings_batch(list(batch)) for batch in batches]
+    batched_embeddings = [embedder.embed(list(batch)) for batch in batches]
 
     res = []
     for embeddings in tqdm(
-        batched_embeddings, desc=f"Generating Embeddings for {len(data)} queries"
+        batched_embeddings, desc=f"Generating Embeddings for {len(texts)} queries"
     ):
-        for embedding in embeddings:
-            res.append(embedding.embedding)
+        res.extend(embeddings)
 
     return res
+
+
+def generate_embeddings(data: list[QueryItem], batch_size, use_cache: bool = True):
+    texts = [item.query for item in data]
+    with record_stage("embedding"), span(
+        "lib.openai_helpers.generate_embeddings",
+        batch_size=len(texts),
+        use_cache=use_cache,
+    ):
+        if not use_cache:
+            return embed_texts(texts, batch_size)
+
+        return get_embedding_cache().get_or_compute(
+            get_embedder().model,
+            None,
+            texts,
+            lambda missing: embed_texts(missing, batch_size),
+        )
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough heuristic of ~4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def batch_by_tokens(texts: list[str], max_tokens: int):
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if batch and (
+            batch_tokens + tokens > max_tokens or len(batch) >= MAX_INPUTS_PER_REQUEST
+        ):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+class AdaptiveBackoff:
+    """
+    Shared backoff across all in-flight requests. Every rate limit error doubles the delay that new requests wait for and every
+    success halves it again so that we settle just below the rate limit.
+    """
+
+    def __init__(self, min_delay: float = 1, max_delay: float = 60):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+
+    async def wait(self):
+        if self.delay:
+            await asyncio.sleep(self.delay * random.uniform(0.5, 1))
+
+    def on_rate_limit(self):
+        self.delay = min(self.max_delay, max(self.min_delay, self.delay * 2))
+
+    def on_success(self):
+        self.delay = self.delay / 2 if self.delay > self.min_delay else 0.0
+
+
+async def embed_batch_async(
+    batch: list[str],
+    sem: asyncio.Semaphore,
+    backoff: AdaptiveBackoff,
+    max_retries: int = 6,
+    use_cache: bool = True,
+) -> list[list[float]]:
+    embedder = get_embedder()
+
+    async def embed(texts: list[str]):
+        for attempt in range(max_retries):
+            await backoff.wait()
+            try:
+                async with sem:
+                    embeddings = await embedder.aembed(texts)
+                backoff.on_success()
+                return embeddings
+            except embedder.rate_limit_errors:
+                backoff.on_rate_limit()
+                if attempt == max_retries - 1:
+                    raise
+
+    with span(
+        "lib.openai_helpers.embed_batch_async",
+        batch_size=len(batch),
+        use_cache=use_cache,
+    ):
+        if not use_cache:
+            return await embed(batch)
+        return await get_embedding_cache().aget_or_compute(
+            embedder.model, None, batch, embed
+        )
+
+
+async def generate_embeddings_async(
+    texts: list[str],
+    max_tokens_per_batch: int = 100_000,
+    max_in_flight: int = 8,
+    max_retries: int = 6,
+    use_cache: bool = True,
+) -> AsyncIterator[list[list[float]]]:
+    """
+    Embeds `texts` in token budgeted batches with up to `max_in_flight` requests running at once. Embeddings for each batch
+    are yielded in input order as soon as that batch (and every batch before it) has completed.
+    """
+    sem = asyncio.Semaphore(max_in_flight)
+    backoff = AdaptiveBackoff()
+
+    def process_batch(batch: list[str]):
+        return embed_batch_async(batch, sem, backoff, max_retries, use_cache)
+
+    # We only schedule a bounded window of batches ahead so that memory stays flat for large inputs
+    pending = deque()
+    progress = tqdm(
+        total=len(texts), desc=f"Generating Embeddings for {len(texts)} texts"
+    )
+    try:
+        for batch in batch_by_tokens(texts, max_tokens_per_batch):
+            pending.append(asyncio.create_task(process_batch(batch)))
+            if len(pending) >= max_in_flight * 2:
+                embeddings = await pending.popleft()
+                progress.update(len(embeddings))
+                yield embeddings
+
+        while pending:
+            embeddings = await pending.popleft()
+            progress.update(len(embeddings))
+            yield embeddings
+    finally:
+        for task in pending:
+            task.cancel()
+        progress.close()
@@ -0,0 +1,159 @@
+from typing import Callable
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+import numpy as np
+
+# Picks the provider used when no name is given, eg. RAG_EMBEDDING_PROVIDER=local to work fully offline
+DEFAULT_PROVIDERS = {
+    "embedding": os.environ.get("RAG_EMBEDDING_PROVIDER", "openai"),
+    "llm": os.environ.get("RAG_LLM_PROVIDER", "openai"),
+}
+
+_factories: dict[tuple[str, str], Callable[[], object]] = {}
+_instances: dict[tuple[str, str], object] = {}
+_lock = threading.Lock()
+
+
+def register_provider(kind: str, name: str):
+    """
+    Registers a factory for a provider. Factories are only called the first time the provider is requested, so they are the
+    place to import SDKs and create clients.
+    """
+
+    def decorator(factory: Callable[[], object]):
+        _factories[(kind, name)] = factory
+        return factory
+
+    return decorator
+
+
+def get_provider(kind: str, name: str | None = None):
+    key = (kind, name or DEFAULT_PROVIDERS[kind])
+    with _lock:
+        if key not in _instances:
+            if key not in _factories:
+                available = sorted(name for kind_, name in _factories if kind_ == kind)
+                raise ValueError(
+                    f"Unknown {kind} provider {key[1]}, expected one of {available}"
+                )
+            _instances[key] = _factories[key]()
+        return _instances[key]
+
+
+def set_provider(kind: str, instance, name: str | None = None):
+    """
+    Replaces the instance served for a provider and returns the previous one (or None) so that it can be restored
+    """
+    key = (kind, name or DEFAULT_PROVIDERS[kind])
+    with _lock:
+        previous = _instances.pop(key, None)
+        if instance is not None:
+            _instances[key] = instance
+        return previous
+
+
+def get_embedder(name: str | None = None):
+    return get_provider("embedding", name)
+
+
+class OpenAIEmbedder:
+    """
+    The OpenAI clients are only created, and the SDK only imported, on the first request
+    """
+
+    def __init__(self, model: str = "text-embedding-3-small", dim: int = 1536):
+        self.model = model
+        self.dim = dim
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import Client
+
+            self._client = Client()
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+
+            self._async_client = AsyncOpenAI()
+        return self._async_client
+
+    @property
+    def rate_limit_errors(self) -> tuple[type[Exception], ...]:
+        from openai import RateLimitError
+
+        return (RateLimitError,)
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        res = self.client.embeddings.create(model=self.model, input=texts)
+        return [item.embedding for item in res.data]
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        res = await self.async_client.embeddings.create(model=self.model, input=texts)
+        return [item.embedding for item in res.data]
+
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+class LocalHashingEmbedder:
+    """
+    Deterministic offline embedder using the hashing trick over the unigrams and bigrams of the text. Texts that share words
+    end up close together so lexical retrieval works, but there is no semantic similarity. `latency` is slept for on every
+    request so that it can stand in for a hosted model in benchmarks.
+    """
+
+    rate_limit_errors: tuple[type[Exception], ...] = ()
+
+    def __init__(self, dim: int = 1536, latency: float = 0):
+        self.dim = dim
+        self.latency = latency
+        self.model = f"local-hashing-{dim}"
+
+    def embed_one(self, text: str) -> list[float]:
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in tokens + [" ".join(pair) for pair in zip(tokens, tokens[1:])]:
+            digest = hashlib.md5(feature.encode()).digest()
+            # The sign bit keeps collisions from only ever adding up
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[int.from_bytes(digest[:4], "little") % self.dim] += sign
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.embed_one(text) for text in texts]
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self.embed_one(text) for text in texts]
+
+
+@register_provider("embedding", "openai")
+def openai_embedder():
+    return OpenAIEmbedder()
+
+
+@register_provider("embedding", "local")
+def local_embedder():
+    return LocalHashingEmbedder()
+
+
+@register_provider("llm", "openai")
+def openai_llm():
+    import instructor
+    from openai import AsyncOpenAI
+
+    return instructor.from_openai(AsyncOpenAI())
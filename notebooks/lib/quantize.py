@@ -0,0 +1,367 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal
+from lancedb.table import Table
+from tqdm import tqdm
+from lib.data import load_query_items
+from lib.db import get_table
+from lib.eval import score_retrieval_batch
+from lib.exact import get_exact_index
+from lib.models import QueryItem
+from lib.openai_helpers import generate_embeddings
+from lib.tracing import traced_search
+import argparse
+import os
+import time
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+LANCE_DIR_PATH = os.path.join(BASE_PATH, "../../lance")
+DATA_DIR = os.path.join(BASE_PATH, "../../data")
+
+Quantization = Literal["none", "int8", "binary"]
+
+
+def truncate(vectors: np.ndarray, dims: int | None) -> np.ndarray:
+    """
+    Matryoshka truncation, text-embedding-3 models are trained so that the leading dimensions can be used on their own once
+    they're renormalized
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dims is None or dims >= vectors.shape[1]:
+        return vectors
+    vectors = vectors[:, :dims]
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class QuantizedIndex:
+    """
+    First stage index over truncated and optionally quantized vectors. Int8 codes use a per dimension scale and binary codes
+    keep only the sign of each dimension packed 8 to a byte. The top `top_k * rescore_factor` candidates are then rescored with
+    the full precision vectors which stay on disk in the memory mapped exact index.
+    """
+
+    def __init__(
+        self,
+        full_vectors: np.ndarray,
+        chunk_ids: np.ndarray,
+        dims: int | None = None,
+        quantization: Quantization = "int8",
+        block_size: int = 16_384,
+    ):
+        self.full_vectors = full_vectors
+        self.chunk_ids = chunk_ids
+        self.dims = dims
+        self.quantization = quantization
+        self.scale = None
+
+        blocks = [
+            truncate(full_vectors[start : start + block_size], dims)
+            for start in range(0, len(full_vectors), block_size)
+        ]
+        if quantization == "int8":
+            self.scale = (
+                np.max([np.abs(block).max(axis=0) for block in blocks], axis=0) / 127
+            )
+            self.scale[self.scale == 0] = 1
+            self.codes = np.concatenate(
+                [np.round(block / self.scale).astype(np.int8) for block in blocks]
+            )
+        elif quantization == "binary":
+            self.codes = np.concatenate(
+                [np.packbits(block > 0, axis=1) for block in blocks]
+            )
+        else:
+            self.codes = np.concatenate(blocks)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def _score_block(self, queries: np.ndarray, start: int, stop: int, k: int):
+        block = self.codes[start:stop]
+        if self.quantization == "binary":
+            # With +-1 vectors the hamming distance is (dims - q.x) / 2 so a matmul gives the same ranking as popcount
+            signs = np.unpackbits(block, axis=1, count=queries.shape[1]).astype(
+                np.float32
+            )
+            distances = -(queries @ (2 * signs - 1).T)
+        else:
+            # All the vectors are normalized so ranking by dot product is the same as ranking by L2
+            distances = -(queries @ block.T.astype(np.float32))
+        k = min(k, len(block))
+        indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(distances, indices, axis=1), indices + start
+
+    def candidates(
+        self,
+        queries: np.ndarray,
+        k: int,
+        block_size: int = 16_384,
+        max_workers: int = 4,
+    ) -> np.ndarray:
+        queries = truncate(queries, self.dims)
+        if self.quantization == "int8":
+            queries = queries * self.scale
+        elif self.quantization == "binary":
+            queries = np.where(queries > 0, 1, -1).astype(np.float32)
+            # Blocks are unpacked to float32 before scoring, so scan fewer rows at a time
+            block_size = max(1, block_size // 4)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            blocks = list(
+                executor.map(
+                    lambda start: self._score_block(
+                        queries, start, start + block_size, k
+                    ),
+                    range(0, len(self.codes), block_size),
+                )
+            )
+
+        distances = np.concatenate([block[0] for block in blocks], axis=1)
+        indices = np.concatenate([block[1] for block in blocks], axis=1)
+        keep = np.argpartition(distances, min(k, distances.shape[1]) - 1, axis=1)
+        return np.take_along_axis(indices, keep[:, :k], axis=1)
+
+    def search(self, queries: np.ndarray, top_k: int, rescore_factor: int = 4):
+        """
+        Returns the top_k rows for each query as `chunk_id` and full precision squared L2 `_distance`. With a `rescore_factor` of 1
+        the full precision vectors only reorder the first stage top_k.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        candidates = self.candidates(queries, top_k * max(rescore_factor, 1))
+
+        results = []
+        for query, rows in zip(queries, candidates):
+            rows = np.sort(rows)
+            vectors = np.asarray(self.full_vectors[rows], dtype=np.float32)
+            distances = ((vectors - query) ** 2).sum(axis=1)
+            order = np.argsort(distances, kind="stable")[:top_k]
+            results.append(
+                [
+                    {"chunk_id": chunk_id, "_distance": float(distance)}
+                    for chunk_id, distance in zip(
+                        self.chunk_ids[rows[order]], distances[order]
+                    )
+                ]
+            )
+        return results
+
+
+_indexes: dict[tuple, QuantizedIndex] = {}
+
+
+def get_quantized_index(
+    table: Table, dims: int | None = None, quantization: Quantization = "int8"
+) -> QuantizedIndex:
+    # The codes are cheap to rebuild from the exported vectors so they're only kept in memory
+    key = (table.name, table.version, dims, quantization)
+    if key not in _indexes:
+        # Drop the codes of older table versions, whatever their dims or quantization, so the cache doesn't grow with every write
+        for stale in [
+            other
+            for other in _indexes
+            if other[0] == table.name and other[1] < table.version
+        ]:
+            del _indexes[stale]
+        exact = get_exact_index(table)
+        _indexes[key] = QuantizedIndex(
+            exact.vectors, exact.chunk_ids, dims, quantization
+        )
+    return _indexes[key]
+
+
+@traced_search
+def quantized_vector_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    index: QuantizedIndex | None = None,
+    rescore_factor: int = 4,
+    batch_size: int = 20,
+    embedded_queries=None,
+):
+    if embedded_queries is None:
+        embedded_queries = generate_embeddings(queries, batch_size)
+    index = index or get_quantized_index(table)
+    return index.search(np.array(embedded_queries), top_k, rescore_factor)
+
+
+def create_reduced_table(
+    db, source: Table, dims: int, name: str | None = None, batch_size: int = 10_000
+) -> Table:
+    """
+    Copies a table with its `vector` column truncated to `dims` so that the ANN index is built over the smaller vectors. The
+    original vector is kept in a `full_vector` side column for rescoring.
+    """
+    name = name or f"{source.name}_{dims}"
+    dim = source.schema.field("vector").type.list_size
+    schema = pa.schema(
+        [
+            (
+                field
+                if field.name != "vector"
+                else pa.field("vector", pa.list_(pa.float32(), dims))
+            )
+            for field in source.schema
+        ]
+        + [pa.field("full_vector", pa.list_(pa.float32(), dim))]
+    )
+
+    def batches():
+        for batch in tqdm(
+            source.to_lance().to_batches(batch_size=batch_size),
+            desc=f"Copying {source.name} to {name}",
+        ):
+            vectors = batch["vector"].values.to_numpy().reshape(-1, dim)
+            columns = {
+                field.name: batch[field.name]
+                for field in source.schema
+                if field.name != "vector"
+            }
+            columns["vector"] = pa.FixedSizeListArray.from_arrays(
+                pa.array(truncate(vectors, dims).ravel()), dims
+            )
+            columns["full_vector"] = batch["vector"]
+            yield pa.RecordBatch.from_pydict(columns, schema=schema)
+
+    return db.create_table(name, data=batches(), schema=schema, mode="overwrite")
+
+
+@traced_search
+def reduced_vector_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    rescore_factor: int = 4,
+    batch_size: int = 20,
+    embedded_queries=None,
+):
+    """
+    Vector search against a table made by `create_reduced_table`, the candidates are rescored with their full precision vector
+    """
+    if embedded_queries is None:
+        embedded_queries = generate_embeddings(queries, batch_size)
+    dims = table.schema.field("vector").type.list_size
+
+    data = []
+    for embedding in tqdm(embedded_queries, desc="Executing reduced vector search"):
+        query = np.asarray(embedding, dtype=np.float32)
+        candidates = (
+            table.search(truncate(query[None, :], dims)[0], query_type="vector")
+            .select(["chunk_id", "full_vector"])
+            .limit(top_k * max(rescore_factor, 1))
+            .to_arrow()
+        )
+        vectors = (
+            candidates["full_vector"]
+            .combine_chunks()
+            .values.to_numpy()
+            .reshape(-1, len(query))
+        )
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        order = np.argsort(distances, kind="stable")[:top_k]
+        chunk_ids = candidates["chunk_id"].to_pylist()
+        data.append(
+            [
+                {"chunk_id": chunk_ids[row], "_distance": float(distances[row])}
+                for row in order
+            ]
+        )
+    return data
+
+
+def benchmark_quantization(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int = 25,
+    dims_grid: list[int | None] = [None, 1024, 512, 256],
+    quantization_grid: list[Quantization] = ["none", "int8", "binary"],
+    rescore_factor: int = 4,
+):
+    """
+    Reports the memory used by the first stage vectors, the latency and the recall@top_k against both the labelled chunks and
+    the exact nearest neighbours for every combination of dimension and quantization
+    """
+    embedded_queries = np.array(generate_embeddings(queries, 100), dtype=np.float32)
+    labels = [query.selected_chunk_ids for query in queries]
+    exact = [
+        [item["chunk_id"] for item in items]
+        for items in get_exact_index(table).search_batch(embedded_queries, top_k)
+    ]
+    recall_key = f"recall@{top_k}"
+
+    results = []
+    for dims in dims_grid:
+        for quantization in quantization_grid:
+            index = get_quantized_index(table, dims, quantization)
+            latencies, retrieved = [], []
+            for embedding in tqdm(
+                embedded_queries, desc=f"Benchmarking dims={dims} {quantization}"
+            ):
+                start = time.perf_counter()
+                items = index.search(embedding[None, :], top_k, rescore_factor)[0]
+                latencies.append(time.perf_counter() - start)
+                retrieved.append([item["chunk_id"] for item in items])
+
+            results.append(
+                {
+                    "dims": dims or embedded_queries.shape[1],
+                    "quantization": quantization,
+                    "memory_mb": index.nbytes / 1024**2,
+                    recall_key: float(
+                        score_retrieval_batch(retrieved, labels, [top_k])[
+                            recall_key
+                        ].mean()
+                    ),
+                    "exact_recall": float(
+                        score_retrieval_batch(retrieved, exact, [top_k])[
+                            recall_key
+                        ].mean()
+                    ),
+                    "mean_ms": float(np.mean(latencies) * 1000),
+                    "p95_ms": float(np.percentile(latencies, 95) * 1000),
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Memory, latency and recall of truncated and quantized vectors with full precision rescoring"
+    )
+    parser.add_argument("--table", default="ms_marco")
+    parser.add_argument(
+        "--queries", default=os.path.join(DATA_DIR, "queries_single_label.jsonl")
+    )
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--top-k", type=int, default=25)
+    parser.add_argument("--dims", type=int, nargs="*", default=[1536, 1024, 512, 256])
+    parser.add_argument("--quantization", nargs="*", default=["none", "int8", "binary"])
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    db = lancedb.connect(LANCE_DIR_PATH)
+    table = get_table(db, args.table)
+    queries = load_query_items(args.queries, args.limit)
+    results = benchmark_quantization(
+        table,
+        queries,
+        args.top_k,
+        args.dims,
+        args.quantization,
+        args.rescore_factor,
+    )
+
+    recall_key = f"recall@{args.top_k}"
+    for result in results:
+        print(
+            f"dims={result['dims']:<5} {result['quantization']:>6}: {result['memory_mb']:.1f}MB "
+            f"{recall_key}={result[recall_key]:.3f} exact_recall={result['exact_recall']:.3f} "
+            f"mean={result['mean_ms']:.2f}ms p95={result['p95_ms']:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
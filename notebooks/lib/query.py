@@ -1,96 +1,424 @@
 from lancedb.table import Table
 from tqdm import tqdm
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import nullcontext
 from lib.openai_helpers import generate_embeddings
 from lancedb.rerankers import LinearCombinationReranker, CohereReranker
-import instructor
-import openai
 from pydantic import BaseModel, Field
 from typing import Literal
 from tqdm.asyncio import tqdm_asyncio as asyncio
 from lib.string_helpers import strip_punctuation
 from lib.models import QueryItem
+from lib.llm import get_gateway
+from lib.timing import record_stage, timed_reranker
+from lib.tracing import span, traced_search
+from lib.index import apply_vector_search_config, load_vector_search_config
+import numpy as np
+import pyarrow as pa
 
+ResultFormat = Literal["hits", "arrow", "numpy", "dicts"]
 
-def fts_search(table: Table, queries: list[QueryItem], top_k: int):
+# Lance adds one of these to the results depending on the query type and whether it was reranked
+SCORE_COLUMNS = ["_relevance_score", "_score", "score", "_distance"]
+
+
+class Hit:
+    """
+    This is a single search result holding only its chunk_id, score and any other projected columns. It supports
+    `hit["chunk_id"]` and `hit.get(...)` like the dicts returned by `.to_list()`, but only for the columns that were projected.
+    """
+
+    __slots__ = ["chunk_id", "score", "score_column", "fields"]
+
+    def __init__(self, chunk_id: str, score: float, score_column: str, fields=None):
+        self.chunk_id = chunk_id
+        self.score = score
+        self.score_column = score_column
+        self.fields = fields
+
+    def __getitem__(self, key: str):
+        if key == "chunk_id":
+            return self.chunk_id
+        if key == self.score_column:
+            return self.score
+        if self.fields is None:
+            raise KeyError(key)
+        return self.fields[key]
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        return {
+            "chunk_id": self.chunk_id,
+            self.score_column: self.score,
+            **(self.fields or {}),
+        }
+
+    def __repr__(self):
+        return f"Hit(chunk_id={self.chunk_id!r}, {self.score_column}={self.score})"
+
+
+def project(query, columns: list[str] | None, required: list[str] = []):
+    """
+    Only reads `columns` (plus anything a reranker or filter needs) back from Lance. `None` reads every column.
+    """
+    if columns is None:
+        return query
+    return query.select(list(dict.fromkeys(["chunk_id", *columns, *required])))
+
+
+def run_query(stage: str, query) -> pa.Table:
+    """
+    Executes a Lance query in its own span and stage timer. Lance runs the search, any reranker and reads back the projected
+    columns all inside `.to_arrow()`.
+    """
+    with record_stage(stage), span(f"lib.query.{stage}"):
+        return query.to_arrow()
+
+
+def format_results(
+    results: pa.Table,
+    result_format: ResultFormat = "dicts",
+    columns: list[str] | None = None,
+):
+    with record_stage("materialize"), span(
+        "lib.query.materialize", rows=results.num_rows, result_format=result_format
+    ):
+        return _format_results(results, result_format, columns)
+
+
+def _format_results(
+    results: pa.Table,
+    result_format: ResultFormat,
+    columns: list[str] | None,
+):
+    if columns is not None:
+        # Drop the columns that were only read for the reranker
+        keep = set(columns) | {"chunk_id"} | set(SCORE_COLUMNS)
+        results = results.select(
+            [name for name in results.column_names if name in keep]
+        )
+
+    if result_format == "arrow":
+        return results
+    if results.num_rows == 0 or "chunk_id" not in results.column_names:
+        # Tantivy returns a table with only a score column when nothing matches
+        if result_format == "numpy":
+            return np.array([], dtype=object), np.array([], dtype=np.float32)
+        return []
+    if result_format == "dicts":
+        return results.to_pylist()
+
+    score_column = next(
+        (name for name in SCORE_COLUMNS if name in results.column_names), None
+    )
+    ids = results["chunk_id"].to_numpy(zero_copy_only=False)
+    scores = (
+        results[score_column].to_numpy(zero_copy_only=False)
+        if score_column
+        else np.zeros(len(ids), dtype=np.float32)
+    )
+    if result_format == "numpy":
+        return ids, scores
+    if result_format != "hits":
+        raise ValueError(f"Unknown result format {result_format}")
+
+    other_columns = [
+        name
+        for name in results.column_names
+        if name != "chunk_id" and name not in SCORE_COLUMNS
+    ]
+    fields = (
+        results.select(other_columns).to_pylist()
+        if other_columns
+        else [None] * len(ids)
+    )
+    return [
+        Hit(chunk_id, score, score_column, row_fields)
+        for chunk_id, score, row_fields in zip(ids.tolist(), scores.tolist(), fields)
+    ]
+
+
+@traced_search
+def fts_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
+):
     data = []
     for query in tqdm(queries, desc="Executing Full Text Search now..."):
-        items = (
-            table.search(strip_punctuation(query.query), query_type="fts")
-            .limit(top_k)
-            .to_list()
+        results = project(
+            table.search(strip_punctuation(query.query), query_type="fts"), columns
+        )
+        data.append(
+            format_results(
+                run_query("fts", results.limit(top_k)), result_format, columns
+            )
         )
-        data.append(items)
     return data
 
 
+@traced_search
 def vector_search(
-    table: Table, queries: list[QueryItem], top_k: int, batch_size: int = 20
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    batch_size: int = 20,
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
 ):
     embedded_queries = generate_embeddings(queries, batch_size)
+    # Picks up the nprobes/refine_factor saved by `python -m lib.index`, if any
+    config = load_vector_search_config(table.name)
     return [
-        table.search(query_embedding, query_type="vector").limit(top_k).to_list()
+        format_results(
+            run_query(
+                "vector",
+                project(
+                    apply_vector_search_config(
+                        table.search(query_embedding, query_type="vector"), config
+                    ),
+                    columns,
+                ).limit(top_k),
+            ),
+            result_format,
+            columns,
+        )
         for query_embedding in tqdm(
             embedded_queries, desc="Executing Vector Search now..."
         )
     ]
 
 
+@traced_search
+def batch_vector_search(
+    tables: list[Table],
+    queries: list[QueryItem],
+    top_k: int,
+    batch_size: int = 20,
+    embedded_queries: list[list[float]] | None = None,
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
+    executor: Executor | None = None,
+    progress: bool = True,
+):
+    """
+    Runs the vector search for every query concurrently over a pool of table handles (see `lib.db.get_table_pool`). A
+    long running caller can pass its own `executor` so the shards don't start a new thread pool for every batch.
+
+    Results are returned in the same order as `queries` and match what `vector_search` returns for each query.
+    """
+    if embedded_queries is None:
+        embedded_queries = generate_embeddings(queries, batch_size)
+
+    config = load_vector_search_config(tables[0].name)
+
+    def search_shard(shard: int):
+        table = tables[shard]
+        return [
+            (
+                idx,
+                format_results(
+                    run_query(
+                        "vector",
+                        project(
+                            apply_vector_search_config(
+                                table.search(
+                                    embedded_queries[idx], query_type="vector"
+                                ),
+                                config,
+                            ),
+                            columns,
+                        ).limit(top_k),
+                    ),
+                    result_format,
+                    columns,
+                ),
+            )
+            for idx in range(shard, len(embedded_queries), len(tables))
+        ]
+
+    data = [None] * len(embedded_queries)
+    with (
+        nullcontext(executor)
+        if executor is not None
+        else ThreadPoolExecutor(max_workers=len(tables))
+    ) as pool:
+        for shard_results in tqdm(
+            pool.map(search_shard, range(len(tables))),
+            total=len(tables),
+            desc=f"Executing Batched Vector Search over {len(tables)} tables...",
+            disable=not progress,
+        ):
+            for idx, items in shard_results:
+                data[idx] = items
+    return data
+
+
+@traced_search
 def hybrid_search(
-    table: Table, queries: list[QueryItem], top_k: int, batch_size: int = 20
+    table: Table,
+    queries: list[QueryItem],
+    top_k: int,
+    batch_size: int = 20,
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
 ):
     return [
-        table.search(strip_punctuation(query.query), query_type="hybrid")
-        .limit(top_k)
-        .to_list()
+        format_results(
+            run_query(
+                "hybrid",
+                project(
+                    table.search(strip_punctuation(query.query), query_type="hybrid"),
+                    columns,
+                ).limit(top_k),
+            ),
+            result_format,
+            columns,
+        )
         for query in tqdm(queries, desc="Executing Hybrid Search now...")
     ]
 
 
+@traced_search
 def linear_combination_search(
-    table: Table, queries, top_k: int, vector_search_weight: float
+    table: Table,
+    queries,
+    top_k: int,
+    vector_search_weight: float,
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
 ):
-    reranker = LinearCombinationReranker(weight=vector_search_weight)
+    reranker = timed_reranker(LinearCombinationReranker(weight=vector_search_weight))
     return [
-        table.search(strip_punctuation(query.query), query_type="hybrid")
-        .rerank(reranker=reranker)
-        .limit(top_k)
-        .to_list()
+        format_results(
+            run_query(
+                "hybrid",
+                project(
+                    table.search(strip_punctuation(query.query), query_type="hybrid"),
+                    columns,
+                )
+                .rerank(reranker=reranker)
+                .limit(top_k),
+            ),
+            result_format,
+            columns,
+        )
         for query in tqdm(
             queries, desc=f"Linear Combination (Weight {vector_search_weight})"
         )
     ]
 
 
+@traced_search
 def cohere_rerank_search(
-    table: Table, queries, top_k: int, model_name: str, query_type="fts"
+    table: Table,
+    queries,
+    top_k: int,
+    model_name: str,
+    query_type="fts",
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
 ):
-    cohere_reranker = CohereReranker(model_name=model_name)
+    cohere_reranker = timed_reranker(CohereReranker(model_name=model_name))
+    # Cohere scores the text of each candidate so it's always read back
     return [
-        table.search(strip_punctuation(query.query), query_type=query_type)
-        .rerank(reranker=cohere_reranker)
-        .limit(top_k)
-        .to_list()
+        format_results(
+            run_query(
+                query_type,
+                project(
+                    table.search(strip_punctuation(query.query), query_type=query_type),
+                    columns,
+                    ["text"],
+                )
+                .rerank(reranker=cohere_reranker)
+                .limit(top_k),
+            ),
+            result_format,
+            columns,
+        )
         for query in tqdm(queries, desc=f"Cohere Reranker ({model_name})")
     ]
 
 
-async def metadata_search(table: Table, queries: list[QueryItem], top_k):
+@traced_search
+def learned_rerank_search(
+    table: Table,
+    queries,
+    top_k: int,
+    reranker,
+    query_type="hybrid",
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
+):
+    """
+    Same as `cohere_rerank_search` but with a local `lib.rerank.LearnedReranker` so there is no network round trip
+    """
+    reranker = timed_reranker(reranker)
+    return [
+        format_results(
+            run_query(
+                query_type,
+                project(
+                    table.search(strip_punctuation(query.query), query_type=query_type),
+                    columns,
+                    ["text"],
+                )
+                .rerank(reranker=reranker)
+                .limit(top_k),
+            ),
+            result_format,
+            columns,
+        )
+        for query in tqdm(queries, desc="Learned Reranker")
+    ]
+
+
+@traced_search
+async def metadata_search(
+    table: Table,
+    queries: list[QueryItem],
+    top_k,
+    classifier=None,
+    columns: list[str] | None = None,
+    result_format: ResultFormat = "dicts",
+):
+    """
+    Filters the full text search by the category of each query. Pass a `LocalCategoryClassifier` as `classifier` to only call the
+    LLM for queries that it isn't confident about.
+    """
     data = []
-    categories = await classify_queries(queries)
+    query_strings = [query.query for query in queries]
+    if classifier is None:
+        categories = [
+            response.category for response in await classify_queries(query_strings)
+        ]
+    else:
+        categories = await classifier.classify(query_strings)
+
     for query, category in tqdm(zip(queries, categories)):
-        items = (
-            table.search(strip_punctuation(query.query), query_type="fts")
-            .where(f"category = '{category.category}'", prefilter=True)
-            .limit(top_k)
-            .to_list()
+        results = run_query(
+            "fts",
+            project(
+                table.search(strip_punctuation(query.query), query_type="fts"),
+                columns,
+                # The FTS path applies the filter after reading the projected columns back
+                ["category"],
+            )
+            .where(f"category = '{category}'", prefilter=True)
+            .limit(top_k),
         )
-        data.append(items)
+        data.append(format_results(results, result_format, columns))
     return data
 
 
 async def classify_queries(queries: list[str]):
-    client = instructor.from_openai(openai.AsyncOpenAI())
-
     category_description = """
     This represents a categorization of the user's query
 
@@ -105,7 +433,7 @@ async def classify_queries(queries: list[str]):
         )
 
     async def classify_query(query: str):
-        return await client.chat.completions.create(
+        return await get_gateway().create(
             messages=[
                 {
                     "role": "system",
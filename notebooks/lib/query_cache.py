@@ -0,0 +1,194 @@
+from collections import OrderedDict
+from copy import deepcopy
+from functools import wraps
+from typing import Callable
+from lancedb.table import Table
+from lib.models import QueryItem
+from lib.string_helpers import strip_punctuation
+import inspect
+import numpy as np
+import pyarrow as pa
+import threading
+import time
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(strip_punctuation(query).split())
+
+
+def copy_result(result):
+    """
+    Copies a cached result so callers can't change the cached entry. Arrow tables are immutable so they're shared, the
+    numpy format's (ids, scores) arrays are copied and lists of dicts or hits are deep copied.
+    """
+    if isinstance(result, pa.Table):
+        return result
+    if isinstance(result, tuple):
+        return tuple(np.copy(array) for array in result)
+    if isinstance(result, list):
+        return deepcopy(result)
+    raise TypeError(f"Can't cache results of type {type(result).__name__}")
+
+
+class QueryCache:
+    """
+    This is an in-process LRU cache with a TTL for the results of the `lib.query` strategies. Entries are keyed by
+    (strategy, table, normalized query, top_k, strategy arguments) and every entry for a table is dropped as soon as the
+    table's version changes.
+    """
+
+    def __init__(self, max_entries: int = 10_000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[tuple, tuple[float, list]] = OrderedDict()
+        self._table_versions: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _check_version(self, table: Table):
+        version = table.version
+        if self._table_versions.get(table.name, version) != version:
+            stale = [key for key in self._entries if key[1] == table.name]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        self._table_versions[table.name] = version
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: tuple, result: list):
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(
+        self,
+        search_fn: Callable,
+        table: Table,
+        queries: list[QueryItem],
+        top_k: int,
+        kwargs: dict,
+    ):
+        config = tuple(sorted((name, repr(value)) for name, value in kwargs.items()))
+        # functools.partial objects don't have a __name__ but their repr includes the bound arguments
+        strategy = getattr(search_fn, "__name__", repr(search_fn))
+        keys = [
+            (strategy, table.name, normalize_query(query.query), top_k, config)
+            for query in queries
+        ]
+
+        with self._lock:
+            self._check_version(table)
+            results = [self.get(key) for key in keys]
+
+        missing = {}
+        for idx, (key, result) in enumerate(zip(keys, results)):
+            if result is None:
+                missing.setdefault(key, []).append(idx)
+
+        with self._lock:
+            n_missing = sum(len(idxs) for idxs in missing.values())
+            self.misses += n_missing
+            self.hits += len(keys) - n_missing
+
+        missing_queries = [queries[idxs[0]] for idxs in missing.values()]
+        return results, missing, missing_queries
+
+    def _fill(self, results: list, missing: dict, fresh_results):
+        for (key, idxs), result in zip(missing.items(), fresh_results):
+            with self._lock:
+                self.put(key, result)
+            for idx in idxs:
+                results[idx] = result
+        return [copy_result(result) for result in results]
+
+    def search(
+        self,
+        search_fn: Callable,
+        table: Table,
+        queries: list[QueryItem],
+        top_k: int,
+        **kwargs,
+    ):
+        """
+        Runs `search_fn` only for the queries that aren't cached and returns results for every query in the original order
+        """
+        results, missing, missing_queries = self._lookup(
+            search_fn, table, queries, top_k, kwargs
+        )
+        fresh_results = (
+            search_fn(table, missing_queries, top_k, **kwargs) if missing else []
+        )
+        return self._fill(results, missing, fresh_results)
+
+    async def search_async(
+        self,
+        search_fn: Callable,
+        table: Table,
+        queries: list[QueryItem],
+        top_k: int,
+        **kwargs,
+    ):
+        """
+        Same as `search` for the async strategies such as `metadata_search`
+        """
+        results, missing, missing_queries = self._lookup(
+            search_fn, table, queries, top_k, kwargs
+        )
+        fresh_results = (
+            await search_fn(table, missing_queries, top_k, **kwargs) if missing else []
+        )
+        return self._fill(results, missing, fresh_results)
+
+    def wrap(self, search_fn: Callable):
+        if inspect.iscoroutinefunction(search_fn):
+
+            @wraps(search_fn)
+            async def cached_async_search_fn(
+                table: Table, queries: list[QueryItem], top_k: int, **kwargs
+            ):
+                return await self.search_async(
+                    search_fn, table, queries, top_k, **kwargs
+                )
+
+            return cached_async_search_fn
+
+        @wraps(search_fn)
+        def cached_search_fn(
+            table: Table, queries: list[QueryItem], top_k: int, **kwargs
+        ):
+            return self.search(search_fn, table, queries, top_k, **kwargs)
+
+        return cached_search_fn
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._table_versions.clear()
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+        }
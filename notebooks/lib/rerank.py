@@ -0,0 +1,202 @@
+from lancedb.rerankers import Reranker
+from lancedb.table import Table
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from tqdm import tqdm
+from lib.models import QueryItem
+from lib.openai_helpers import generate_embeddings
+from lib.string_helpers import strip_punctuation
+import pickle
+import time
+import numpy as np
+import pyarrow as pa
+
+
+def tokenize(text: str) -> set[str]:
+    return set(strip_punctuation(text).lower().split())
+
+
+SCORE_COLUMNS = ["_score", "score", "_distance"]
+
+
+def _normalized_column(results: pa.Table, names: list[str], fill: float) -> np.ndarray:
+    """
+    Min-max normalizes the first of `names` in the results the same way Lance does for each leg of a hybrid search, so the
+    features look the same whether or not Lance has already normalized them. Missing values are filled in afterwards.
+    """
+    for name in names:
+        if name in results.column_names:
+            values = results[name].to_numpy(zero_copy_only=False).astype(np.float64)
+            present = ~np.isnan(values)
+            if present.any():
+                low, high = values[present].min(), values[present].max()
+                values = (values - low) / (high - low) if high > low else values * 0
+            return np.nan_to_num(values, nan=fill)
+    return np.full(len(results), fill)
+
+
+def extract_features(query: str, results: pa.Table) -> np.ndarray:
+    query_terms = tokenize(query)
+    doc_terms = [tokenize(text) for text in results["text"].to_pylist()]
+    # Missing scores mean the candidate only came back from the other leg, so it gets the worst normalized score
+    bm25 = _normalized_column(results, ["_score", "score"], 0.0)
+    distance = _normalized_column(results, ["_distance"], 1.0)
+    overlap = np.array(
+        [len(query_terms & terms) / max(len(query_terms), 1) for terms in doc_terms]
+    )
+    length = np.log1p([len(terms) for terms in doc_terms])
+    return np.column_stack([bm25, distance, overlap, length])
+
+
+class LearnedReranker(Reranker):
+    """
+    This is a local learning-to-rank reranker which scores candidates with a logistic regression over BM25 score, vector
+    distance, query term overlap and document length. It plugs into `.rerank(reranker=...)` like any other Lance reranker.
+
+    If `latency_budget_ms` is set we only score as many candidates per query as we can afford within that budget. With
+    `return_score="relevance"` only `_relevance_score` is returned, `"all"` also keeps the original search scores.
+    """
+
+    def __init__(
+        self, latency_budget_ms: float | None = None, return_score="relevance"
+    ):
+        super().__init__(return_score)
+        self.return_score = return_score
+        self.model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+        self.latency_budget_ms = latency_budget_ms
+        self.seconds_per_candidate = None
+
+    @property
+    def max_candidates(self) -> int | None:
+        if self.latency_budget_ms is None or not self.seconds_per_candidate:
+            return None
+        return max(1, int(self.latency_budget_ms / 1000 / self.seconds_per_candidate))
+
+    def fit(self, features: np.ndarray, labels: np.ndarray):
+        self.model.fit(features, labels)
+        return self
+
+    def score_batch(self, queries: list[str], candidates: list[pa.Table]):
+        """
+        Scores the candidates of every query with a single call to the model
+        """
+        if self.max_candidates:
+            candidates = [
+                results.slice(0, self.max_candidates) for results in candidates
+            ]
+
+        started_at = time.perf_counter()
+        features = [
+            extract_features(query, results)
+            for query, results in zip(queries, candidates)
+        ]
+        if not any(len(query_features) for query_features in features):
+            return candidates, [np.array([]) for _ in candidates]
+
+        scores = self.model.predict_proba(np.concatenate(features))[:, 1]
+
+        # Running estimate of the cost per candidate, used to size `max_candidates` to the latency budget
+        cost = (time.perf_counter() - started_at) / len(scores)
+        self.seconds_per_candidate = (
+            cost
+            if self.seconds_per_candidate is None
+            else 0.9 * self.seconds_per_candidate + 0.1 * cost
+        )
+        offsets = np.cumsum([0] + [len(query_features) for query_features in features])
+        return candidates, [
+            scores[start:end] for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+    def _rerank(self, query: str, results: pa.Table) -> pa.Table:
+        (results,), (scores,) = self.score_batch([query], [results])
+        results = results.append_column(
+            "_relevance_score", pa.array(scores, type=pa.float32())
+        )
+        if self.return_score == "relevance":
+            results = results.drop_columns(
+                [name for name in SCORE_COLUMNS if name in results.column_names]
+            )
+        return results.sort_by([("_relevance_score", "descending")])
+
+    def rerank_hybrid(
+        self, query: str, vector_results: pa.Table, fts_results: pa.Table
+    ):
+        return self._rerank(query, self.merge_results(vector_results, fts_results))
+
+    def rerank_vector(self, query: str, vector_results: pa.Table):
+        return self._rerank(query, vector_results)
+
+    def rerank_fts(self, query: str, fts_results: pa.Table):
+        return self._rerank(query, fts_results)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: str) -> "LearnedReranker":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def get_candidates(table: Table, query: str, embedding, depth: int) -> pa.Table:
+    """
+    Union of the full text and vector search candidates for a query with both the BM25 score and vector distance attached
+    """
+    fts_results = (
+        table.search(strip_punctuation(query), query_type="fts")
+        .select(["chunk_id", "text"])
+        .limit(depth)
+        .to_arrow()
+    )
+    vector_results = (
+        table.search(embedding, query_type="vector")
+        .select(["chunk_id", "text"])
+        .limit(depth)
+        .to_arrow()
+    )
+
+    candidates = {}
+    for row in fts_results.to_pylist():
+        candidates[row["chunk_id"]] = {
+            "chunk_id": row["chunk_id"],
+            "text": row["text"],
+            "_score": row.get("_score", row.get("score")),
+            "_distance": None,
+        }
+    for row in vector_results.to_pylist():
+        candidate = candidates.setdefault(
+            row["chunk_id"],
+            {"chunk_id": row["chunk_id"], "text": row["text"], "_score": None},
+        )
+        candidate["_distance"] = row["_distance"]
+    return pa.Table.from_pylist(list(candidates.values()))
+
+
+def train_learned_reranker(
+    table: Table,
+    queries: list[QueryItem],
+    depth: int = 50,
+    latency_budget_ms: float | None = None,
+    batch_size: int = 20,
+) -> LearnedReranker:
+    embedded_queries = generate_embeddings(queries, batch_size)
+    features, labels = [], []
+    for query, embedding in tqdm(
+        zip(queries, embedded_queries),
+        total=len(queries),
+        desc="Collecting reranker training data",
+    ):
+        candidates = get_candidates(table, query.query, embedding, depth)
+        if len(candidates) == 0:
+            continue
+        features.append(extract_features(query.query, candidates))
+        selected = set(query.selected_chunk_ids)
+        labels.append(
+            [chunk_id in selected for chunk_id in candidates["chunk_id"].to_pylist()]
+        )
+
+    return LearnedReranker(latency_budget_ms).fit(
+        np.concatenate(features), np.concatenate(labels)
+    )
@@ -0,0 +1,75 @@
+from lancedb.pydantic import LanceModel, Vector
+from lancedb.embeddings import TextEmbeddingFunction, get_registry, register
+from lancedb.embeddings.openai import OpenAIEmbeddings
+from lib.embedding_cache import get_embedding_cache
+from lib.providers import DEFAULT_PROVIDERS, LocalHashingEmbedder
+from lib.timing import record_stage
+from lib.tracing import span
+
+
+@register("openai-cached")
+class CachedOpenAIEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAI embedding function which checks our on-disk embedding cache before calling the API
+    """
+
+    def generate_embeddings(self, texts):
+        with record_stage("embedding"), span(
+            "lib.models.generate_embeddings", model=self.name, batch_size=len(texts)
+        ):
+            return get_embedding_cache().get_or_compute(
+                self.name, self.dim, list(texts), super().generate_embeddings
+            )
+
+
+@register("local-hashing")
+class LocalHashingEmbeddings(TextEmbeddingFunction):
+    """
+    Lance embedding function for the offline `lib.providers.LocalHashingEmbedder`
+    """
+
+    dim: int = 1536
+
+    def ndims(self):
+        return self.dim
+
+    def generate_embeddings(self, texts):
+        with record_stage("embedding"):
+            return LocalHashingEmbedder(self.dim).embed(list(texts))
+
+
+if DEFAULT_PROVIDERS["embedding"] == "local":
+    func = get_registry().get("local-hashing").create()
+else:
+    func = get_registry().get("openai-cached").create(name="text-embedding-3-small")
+
+
+class EmbeddedPassage(LanceModel):
+    vector: Vector(dim=func.ndims()) = func.VectorField()  # type: ignore
+    chunk_id: str
+    text: str = func.SourceField()
+
+
+class EmbeddedPassageWithQA(LanceModel):
+    vector: Vector(func.ndims()) = func.VectorField()
+    chunk_id: str
+    text: str = func.SourceField()
+    source_text: str
+
+
+class EmbeddedPassageWithMetadata(LanceModel):
+    vector: Vector(func.ndims()) = func.VectorField()
+    chunk_id: str
+    text: str = func.SourceField()
+    keywords: str
+    search_queries: str
+
+
+class ArxivPaper(LanceModel):
+    title: str
+    authors: str
+    category: str
+    abstract: str
+    text: str = func.SourceField()
+    vector: Vector(func.ndims()) = func.VectorField(default=None)
+    chunk_id: str
@@ -0,0 +1,528 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Awaitable, Callable, Literal
+from lib.data import load_query_items
+from lib.db import get_table_pool
+from lib.fusion import Legs, fuse
+from lib.models import QueryItem
+from lib.openai_helpers import generate_embeddings
+from lib.query import batch_vector_search
+from lib.string_helpers import strip_punctuation
+from lib.tracing import LatencyHistogram, span
+import argparse
+import asyncio
+import json
+import os
+import time
+import lancedb
+import numpy as np
+import tantivy
+from lancedb.fts import search_index
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+LANCE_DIR_PATH = os.path.join(BASE_PATH, "../../lance")
+DATA_DIR = os.path.join(BASE_PATH, "../../data")
+
+Strategy = Literal["vector", "fts", "fusion"]
+STRATEGIES = ["vector", "fts", "fusion"]
+
+# Candidates taken from each leg before fusing, the same as `lib.fusion.search_legs`
+FUSION_DEPTH = 50
+
+
+class Overloaded(Exception):
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Request:
+    __slots__ = ["query", "top_k", "deadline", "future"]
+
+    def __init__(self, query: str, top_k: int, deadline: float, future: asyncio.Future):
+        self.query = query
+        self.top_k = top_k
+        self.deadline = deadline
+        self.future = future
+
+
+class MicroBatcher:
+    """
+    Collects requests and hands them to `run_batch` either once `max_batch_size` are waiting or `max_wait_ms` after the first
+    one arrived
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[list[Request]], Awaitable[None]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._pending: list[Request] = []
+        self._timer = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, request: Request):
+        self._pending.append(request)
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_wait_ms / 1000, self._flush
+            )
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self.run_batch(batch))
+        # Keep a reference so the task isn't garbage collected while it runs
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+class RetrievalServer:
+    """
+    Keeps a pool of open table handles warm and serves the `lib.query` strategies to concurrent callers. Requests are grouped
+    into micro batches per strategy so that each batch makes a single embedding call and a single batched search.
+
+    Requests are rejected with `Overloaded` once `max_pending` are queued or running, and fail with `DeadlineExceeded` if they
+    aren't answered within their timeout. Requests that expire while queued are dropped before they're searched.
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        db_path: str = LANCE_DIR_PATH,
+        pool_size: int = 8,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5,
+        max_pending: int = 256,
+        max_in_flight_batches: int = 2,
+        default_timeout_ms: float = 2000,
+    ):
+        self.table_name = table_name
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_pending = max_pending
+        self.max_in_flight_batches = max_in_flight_batches
+        self.default_timeout_ms = default_timeout_ms
+        self.tables = []
+        self.datasets = []
+        self.fts_index = None
+        self.pending = 0
+        self.latency = LatencyHistogram()
+        self.stats = {"served": 0, "shed": 0, "expired": 0, "errors": 0, "batches": 0}
+
+    def start(self):
+        db = lancedb.connect(self.db_path)
+        self.tables = get_table_pool(db, self.table_name, self.pool_size)
+        self.datasets = [table.to_lance() for table in self.tables]
+        # Lance opens the tantivy index again for every full text query, so we keep it open here and only use Lance to read
+        # back the matching rows
+        self.fts_index = tantivy.Index.open(self.tables[0]._get_fts_index_path())
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        self._batch_slots = asyncio.Semaphore(self.max_in_flight_batches)
+        self._batchers = {
+            strategy: MicroBatcher(
+                lambda batch, strategy=strategy: self._run_batch(strategy, batch),
+                self.max_batch_size,
+                self.max_wait_ms,
+            )
+            for strategy in STRATEGIES
+        }
+
+        # Touch the vector and tantivy indices on every handle so the first requests don't pay for loading them
+        def warm(shard: int):
+            self._fts(shard, "warmup", 1, ["chunk_id"])
+            table = self.tables[shard]
+            dim = table.schema.field("vector").type.list_size
+            table.search(np.zeros(dim, dtype=np.float32)).limit(1).to_arrow()
+
+        list(self.executor.map(warm, range(len(self.tables))))
+        return self
+
+    def _fts(self, shard: int, query: str, top_k: int, columns: list[str]):
+        """
+        Full text search against the resident tantivy index, the matching rows are read from the `shard`th table handle. Rows
+        come back best first with the BM25 `score` attached like Lance's FTS query.
+        """
+        with span("lib.server.tantivy", top_k=top_k):
+            hits = search_index(self.fts_index, strip_punctuation(query), top_k)
+        row_ids, scores = hits if hits else ([], [])
+        if not row_ids:
+            return []
+        with span("lib.server.materialize", rows=len(row_ids)):
+            rows = (
+                self.datasets[shard % len(self.datasets)]
+                .take(list(row_ids), columns=columns)
+                .to_pylist()
+            )
+        for row, score in zip(rows, scores):
+            row["score"] = score
+        return rows
+
+    def _search(self, strategy: Strategy, queries: list[str], top_k: int):
+        items = [QueryItem(query=query, selected_chunk_ids=[]) for query in queries]
+        if strategy == "fts":
+            return list(
+                self.executor.map(
+                    lambda idx: self._fts(
+                        idx, queries[idx], top_k, ["chunk_id", "text"]
+                    ),
+                    range(len(queries)),
+                )
+            )
+
+        embedded_queries = generate_embeddings(items, len(items))
+        if strategy == "vector":
+            return batch_vector_search(
+                self.tables,
+                items,
+                top_k,
+                embedded_queries=embedded_queries,
+                columns=["chunk_id", "text"],
+                result_format="dicts",
+                executor=self.executor,
+                progress=False,
+            )
+        if strategy == "fusion":
+            # Both legs are spread over the whole pool of handles
+            fts_results = self.executor.map(
+                lambda idx: self._fts(idx, queries[idx], FUSION_DEPTH, ["chunk_id"]),
+                range(len(queries)),
+            )
+            vector_results = batch_vector_search(
+                self.tables,
+                items,
+                FUSION_DEPTH,
+                embedded_queries=embedded_queries,
+                columns=["chunk_id"],
+                result_format="numpy",
+                executor=self.executor,
+                progress=False,
+            )
+            legs = [
+                Legs(
+                    [row["chunk_id"] for row in rows],
+                    np.array([row["score"] for row in rows], dtype=np.float32),
+                    vector_ids.tolist(),
+                    vector_distances,
+                )
+                for rows, (vector_ids, vector_distances) in zip(
+                    fts_results, vector_results
+                )
+            ]
+            return fuse(legs, top_k)
+        raise ValueError(f"Unknown strategy {strategy}")
+
+    async def _run_batch(self, strategy: Strategy, batch: list[Request]):
+        loop = asyncio.get_running_loop()
+        live = []
+        for request in batch:
+            # Callers that already timed out have cancelled their future
+            if request.future.done():
+                continue
+            if request.deadline <= loop.time():
+                request.future.set_exception(DeadlineExceeded())
+                continue
+            live.append(request)
+        if not live:
+            return
+
+        async with self._batch_slots:
+            top_k = max(request.top_k for request in live)
+            with span(
+                "lib.server.batch",
+                strategy=strategy,
+                batch_size=len(live),
+                top_k=top_k,
+            ):
+                try:
+                    results = await loop.run_in_executor(
+                        None,
+                        self._search,
+                        strategy,
+                        [request.query for request in live],
+                        top_k,
+                    )
+                except Exception as e:
+                    for request in live:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    return
+
+        self.stats["batches"] += 1
+        for request, items in zip(live, results):
+            if not request.future.done():
+                request.future.set_result(items[: request.top_k])
+
+    async def search(
+        self,
+        query: str,
+        top_k: int = 25,
+        strategy: Strategy = "vector",
+        timeout_ms: float | None = None,
+    ) -> list[dict]:
+        if strategy not in self._batchers:
+            raise ValueError(f"Unknown strategy {strategy}")
+        if self.pending >= self.max_pending:
+            self.stats["shed"] += 1
+            raise Overloaded(f"{self.pending} requests are already pending")
+
+        loop = asyncio.get_running_loop()
+        timeout = (timeout_ms or self.default_timeout_ms) / 1000
+        start = loop.time()
+        request = Request(query, top_k, start + timeout, loop.create_future())
+
+        self.pending += 1
+        try:
+            self._batchers[strategy].submit(request)
+            items = await asyncio.wait_for(request.future, timeout)
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            self.stats["expired"] += 1
+            raise DeadlineExceeded(f"No results within {timeout * 1000:.0f}ms")
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        self.stats["served"] += 1
+        self.latency.observe((loop.time() - start) * 1000)
+        return items
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """
+        Line delimited JSON, every line is a request and is answered with a line containing its `id` and either `results` or
+        an `error`. Requests on a connection are handled concurrently so responses can come back out of order.
+        """
+        lock = asyncio.Lock()
+
+        async def respond(message: dict):
+            try:
+                response = {
+                    "id": message.get("id"),
+                    "results": await self.search(
+                        message["query"],
+                        message.get("top_k", 25),
+                        message.get("strategy", "vector"),
+                        message.get("timeout_ms"),
+                    ),
+                }
+            except Overloaded as e:
+                response = {
+                    "id": message.get("id"),
+                    "error": "overloaded",
+                    "detail": str(e),
+                }
+            except DeadlineExceeded as e:
+                response = {
+                    "id": message.get("id"),
+                    "error": "deadline",
+                    "detail": str(e),
+                }
+            except Exception as e:
+                response = {
+                    "id": message.get("id"),
+                    "error": "internal",
+                    "detail": repr(e),
+                }
+            async with lock:
+                writer.write((json.dumps(response, default=str) + "\n").encode())
+                await writer.drain()
+
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message.get("stats"):
+                    async with lock:
+                        writer.write((json.dumps(self.get_stats()) + "\n").encode())
+                        await writer.drain()
+                    continue
+                task = asyncio.create_task(respond(message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "pending": self.pending,
+            "latency": self.latency.summary(),
+        }
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving {self.table_name} on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+async def run_load(
+    queries: list[str],
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    qps: float = 50,
+    duration: float = 30,
+    connections: int = 8,
+    top_k: int = 25,
+    strategy: Strategy = "vector",
+    timeout_ms: float | None = None,
+):
+    """
+    Open loop load generator, requests are sent at a fixed rate regardless of how quickly the server answers so that queueing
+    shows up in the tail latencies instead of slowing down the client
+    """
+    loop = asyncio.get_running_loop()
+    streams = [await asyncio.open_connection(host, port) for _ in range(connections)]
+    waiting: dict[int, tuple[float, asyncio.Future]] = {}
+    latencies, errors = [], {}
+
+    async def read_responses(reader: asyncio.StreamReader):
+        while line := await reader.readline():
+            response = json.loads(line)
+            sent_at, future = waiting.pop(response["id"])
+            if "error" in response:
+                errors[response["error"]] = errors.get(response["error"], 0) + 1
+            else:
+                latencies.append(loop.time() - sent_at)
+            future.set_result(None)
+
+    readers = [loop.create_task(read_responses(reader)) for reader, _ in streams]
+
+    n_requests = int(qps * duration)
+    start = loop.time()
+    futures = []
+    for idx in range(n_requests):
+        delay = start + idx / qps - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        future = loop.create_future()
+        waiting[idx] = (loop.time(), future)
+        futures.append(future)
+        message = {
+            "id": idx,
+            "query": queries[idx % len(queries)],
+            "top_k": top_k,
+            "strategy": strategy,
+            "timeout_ms": timeout_ms,
+        }
+        _, writer = streams[idx % connections]
+        writer.write((json.dumps(message) + "\n").encode())
+
+    await asyncio.gather(*futures)
+    elapsed = loop.time() - start
+    for reader_task, (_, writer) in zip(readers, streams):
+        writer.close()
+        reader_task.cancel()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests": n_requests,
+        "target_qps": qps,
+        "achieved_qps": len(latencies) / elapsed,
+        "errors": errors,
+        **{
+            f"p{p}_ms": float(np.percentile(latencies, p)) if len(latencies) else None
+            for p in [50, 95, 99]
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Long lived retrieval server and a load generator to measure it"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve")
+    serve.add_argument("--table", default="ms_marco")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--pool-size", type=int, default=8)
+    serve.add_argument("--max-batch-size", type=int, default=32)
+    serve.add_argument("--max-wait-ms", type=float, default=5)
+    serve.add_argument("--max-pending", type=int, default=256)
+    serve.add_argument("--timeout-ms", type=float, default=2000)
+    serve.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use the offline embedding and reranker stand ins from lib.benchmark instead of OpenAI and Cohere",
+    )
+
+    load = subparsers.add_parser("load")
+    load.add_argument("--host", default="127.0.0.1")
+    load.add_argument("--port", type=int, default=8765)
+    load.add_argument(
+        "--queries", default=os.path.join(DATA_DIR, "queries_single_label.jsonl")
+    )
+    load.add_argument("--limit", type=int, default=None)
+    load.add_argument("--qps", type=float, default=50)
+    load.add_argument("--duration", type=float, default=30)
+    load.add_argument("--connections", type=int, default=8)
+    load.add_argument("--top-k", type=int, default=25)
+    load.add_argument("--strategy", choices=STRATEGIES, default="vector")
+    load.add_argument("--timeout-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if args.offline:
+            from lib.benchmark import offline
+
+            context = offline(embedding_latency=0.05, rerank_latency=0.1)
+        else:
+            context = nullcontext()
+        with context:
+            server = RetrievalServer(
+                args.table,
+                pool_size=args.pool_size,
+                max_batch_size=args.max_batch_size,
+                max_wait_ms=args.max_wait_ms,
+                max_pending=args.max_pending,
+                default_timeout_ms=args.timeout_ms,
+            )
+
+            async def serve():
+                server.start()
+                await server.serve(args.host, args.port)
+
+            asyncio.run(serve())
+        return
+
+    queries = [item.query for item in load_query_items(args.queries, args.limit)]
+    started_at = time.time()
+    report = asyncio.run(
+        run_load(
+            queries,
+            args.host,
+            args.port,
+            args.qps,
+            args.duration,
+            args.connections,
+            args.top_k,
+            args.strategy,
+            args.timeout_ms,
+        )
+    )
+    print(json.dumps({"started_at": started_at, **report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
-import instructor
-import openai
 from pydantic import BaseModel, Field
 from tqdm.asyncio import tqdm_asyncio as asyncio
-from asyncio import Semaphore
-from tenacity import retry, stop_after_attempt, wait_random_exponential
-from lib.models import ArxivPaper
+from asyncio import Semaphore, Condition, Queue, create_task
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Iterable
+from tqdm import tqdm
+from lib.llm import get_gateway
+import hashlib
+import json
+import os
+import time
 
-client = instructor.from_openai(openai.AsyncOpenAI())
+if TYPE_CHECKING:
+    from lib.schemas import ArxivPaper
 
 
 class QuestionAnswerResponse(BaseModel):
@@ -42,92 +46,256 @@ class Metadata(BaseModel):
     )
 
 
-async def generate_question_batch(
-    text_chunk_batch, max_concurrent_calls: int, model_name="gpt-4o"
-):
-    sem = Semaphore(max_concurrent_calls)
+async def generate_question(text: str, model_name="gpt-4o"):
+    return await get_gateway().create(
+        model=model_name,
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a world class search engine. You are about to be passed a text chunk and your job is to generate a hypothetical question and answer pair that a user might ask to search for in order to retrieve the text chunk. Make sure to use information that is unique to the text chunk itself and also explain any sort of information/accronym that you use in the answer.",
+            },
+            {"role": "user", "content": f"Here is the text chunk : {text}"},
+        ],
+        response_model=QuestionAnswerResponse,
+        max_retries=3,
+    )
+
 
-    @retry(
-        wait=wait_random_exponential(multiplier=1, min=10, max=90),
-        stop=stop_after_attempt(3),
+async def generate_category_question(text: "ArxivPaper", model_name="gpt-3.5-turbo"):
+    return await get_gateway().create(
+        model=model_name,
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a world class question generator. You are about to be passed a text chunk. Your job is to generate a question and answer that will enable a user to find similar chunks. Make sure not to include the title of the text chunk within the question",
+            },
+            {"role": "user", "content": f"Here is the text chunk : {text}"},
+        ],
+        response_model=QuestionAnswerResponse,
+        max_retries=3,
     )
-    async def generate_question(text: str):
-        async with sem:
-            question = await client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a world class search engine. You are about to be passed a text chunk and your job is to generate a hypothetical question and answer pair that a user might ask to search for in order to retrieve the text chunk. Make sure to use information that is unique to the text chunk itself and also explain any sort of information/accronym that you use in the answer.",
-                    },
-                    {"role": "user", "content": f"Here is the text chunk : {text}"},
-                ],
-                response_model=QuestionAnswerResponse,
-                max_retries=3,
-            )
-            return (question, text)
 
-    coros = [generate_question(item) for item in text_chunk_batch]
-    res = await asyncio.gather(*coros)
-    return [{"response": item, "source": text} for item, text in res]
 
+async def generate_metadata(text_chunk: str, model_name: str = "gpt-3.5-turbo"):
+    return await get_gateway().create(
+        model=model_name,
+        response_model=Metadata,
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a world class query indexing system. You are about to be passed a text chunk and you'll need to generate some metadata that will allow you to retrieve this specific chunk when the user makes a relevant query",
+            },
+            {"role": "user", "content": f"The text chunk is {text_chunk}"},
+        ],
+    )
 
-async def generate_category_questions(
-    data: list[ArxivPaper], max_concurrent_calls: int, model_name="gpt-3.5-turbo"
-):
+
+async def _generate_batch(items, max_concurrent_calls: int, generate_fn):
     sem = Semaphore(max_concurrent_calls)
 
-    @retry(
-        wait=wait_random_exponential(multiplier=1, min=10, max=90),
-        stop=stop_after_attempt(3),
-    )
-    async def generate_question(text: ArxivPaper):
+    async def generate(item):
         async with sem:
-            question = await client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a world class question generator. You are about to be passed a text chunk. Your job is to generate a question and answer that will enable a user to find similar chunks. Make sure not to include the title of the text chunk within the question",
-                    },
-                    {"role": "user", "content": f"Here is the text chunk : {text}"},
-                ],
-                response_model=QuestionAnswerResponse,
-                max_retries=3,
-            )
-            return (question, text)
+            return (await generate_fn(item), item)
 
-    coros = [generate_question(item) for item in data]
+    coros = [generate(item) for item in items]
     res = await asyncio.gather(*coros)
-    return [{"response": item, "source": text} for item, text in res]
+    return [{"response": response, "source": item} for response, item in res]
+
+
+async def generate_question_batch(
+    text_chunk_batch, max_concurrent_calls: int, model_name="gpt-4o"
+):
+    return await _generate_batch(
+        text_chunk_batch,
+        max_concurrent_calls,
+        lambda text: generate_question(text, model_name),
+    )
+
+
+async def generate_category_questions(
+    data: list["ArxivPaper"], max_concurrent_calls: int, model_name="gpt-3.5-turbo"
+):
+    return await _generate_batch(
+        data,
+        max_concurrent_calls,
+        lambda paper: generate_category_question(paper, model_name),
+    )
 
 
 async def generate_metadata_batch(
     text_chunk_batch, max_concurrent_calls: int, model_name: str = "gpt-3.5-turbo"
 ):
-    sem = Semaphore(max_concurrent_calls)
-
-    @retry(
-        wait=wait_random_exponential(multiplier=1, min=10, max=90),
-        stop=stop_after_attempt(3),
+    return await _generate_batch(
+        text_chunk_batch,
+        max_concurrent_calls,
+        lambda text_chunk: generate_metadata(text_chunk, model_name),
     )
-    async def enhance_query(text_chunk: str):
-        async with sem:
-            return (
-                await client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    response_model=Metadata,
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "You are a world class query indexing system. You are about to be passed a text chunk and you'll need to generate some metadata that will allow you to retrieve this specific chunk when the user makes a relevant query",
-                        },
-                        {"role": "user", "content": f"The text chunk is {text_chunk}"},
-                    ],
-                ),
-                text_chunk,
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit which grows by one call per round trip while calls are fast and succeed, and is halved whenever we get
+    rate limited or latency goes above `latency_target` seconds.
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        minimum: int = 1,
+        maximum: int = 128,
+        latency_target: float = 15,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._condition = Condition()
+        self._last_decrease = 0.0
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: float, rate_limited: bool):
+        async with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if rate_limited or latency > self.latency_target:
+                # Only back off once per round trip, otherwise every in flight call would halve the limit again
+                if now - self._last_decrease > latency:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+def _completed_keys(output_path: str) -> set[str]:
+    if not os.path.exists(output_path):
+        return set()
+    keys = set()
+    with open(output_path, "rb+") as f:
+        offset = 0
+        for line in f:
+            try:
+                keys.add(json.loads(line)["key"])
+            except (ValueError, KeyError, TypeError):
+                if not line.endswith(b"\n"):
+                    # A crash mid-write leaves a partial last line, cut it off so that the next result starts on a new line
+                    f.truncate(offset)
+                    break
+            offset += len(line)
+    return keys
+
+
+def _should_back_off(error: Exception) -> bool:
+    # Only errors that mean the API is overloaded should shrink the concurrency, not eg. a response that failed validation
+    from openai import APITimeoutError, RateLimitError
+
+    return isinstance(error, (RateLimitError, APITimeoutError, TimeoutError))
+
+
+def _serialize(item):
+    return item.model_dump() if isinstance(item, BaseModel) else item
+
+
+async def stream_generation(
+    items: Iterable,
+    output_path: str,
+    generate_fn: Callable[..., Awaitable[BaseModel]],
+    key_fn: Callable = lambda text: hashlib.md5(text.encode()).hexdigest(),
+    limiter: AIMDLimiter | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Runs `generate_fn` over `items` and appends each result to `output_path` as soon as it completes, keyed by `key_fn` (the md5
+    of the chunk by default). Items whose key is already in the file are skipped so a crashed run can simply be restarted.
+    Concurrency is adjusted by `limiter` based on latency and rate limit errors.
+    """
+    limiter = limiter or AIMDLimiter()
+    gateway = get_gateway()
+    completed = _completed_keys(output_path)
+    pending = (item for item in items if key_fn(item) not in completed)
+    results = Queue(maxsize=limiter.maximum)
+    progress = tqdm(desc=f"Generating into {os.path.basename(output_path)}")
+    if completed:
+        print(f"Skipping {len(completed)} items already in {output_path}")
+
+    async def worker():
+        for item in pending:
+            await limiter.acquire()
+            rate_limited_before = gateway.stats["rate_limited"]
+            start = time.perf_counter()
+            try:
+                response = await generate_fn(item)
+            except Exception as e:
+                await limiter.release(
+                    time.perf_counter() - start,
+                    _should_back_off(e)
+                    or gateway.stats["rate_limited"] > rate_limited_before,
+                )
+                await results.put(e)
+                continue
+            await limiter.release(
+                time.perf_counter() - start,
+                gateway.stats["rate_limited"] > rate_limited_before,
             )
+            await results.put(
+                {
+                    "key": key_fn(item),
+                    "response": response.model_dump(),
+                    "source": _serialize(item),
+                }
+            )
+        await results.put(None)
 
-    coros = [enhance_query(item) for item in text_chunk_batch]
-    res = await asyncio.gather(*coros)
-    return [{"response": item, "source": text} for item, text in res]
+    workers = [create_task(worker()) for _ in range(limiter.maximum)]
+    remaining, failed = len(workers), 0
+    try:
+        with open(output_path, "a") as f:
+            while remaining:
+                result = await results.get()
+                if result is None:
+                    remaining -= 1
+                elif isinstance(result, Exception):
+                    # Failed items aren't written so they are retried on the next run
+                    failed += 1
+                    progress.set_postfix(failed=failed, limit=int(limiter.limit))
+                else:
+                    f.write(json.dumps(result) + "\n")
+                    f.flush()
+                    progress.update(1)
+                    progress.set_postfix(failed=failed, limit=int(limiter.limit))
+                    yield result
+    finally:
+        for task in workers:
+            task.cancel()
+        progress.close()
+
+
+def stream_question_generation(text_chunks, output_path: str, model_name="gpt-4o"):
+    return stream_generation(
+        text_chunks, output_path, lambda text: generate_question(text, model_name)
+    )
+
+
+def stream_category_questions(
+    data: Iterable["ArxivPaper"], output_path: str, model_name="gpt-3.5-turbo"
+):
+    return stream_generation(
+        data,
+        output_path,
+        lambda paper: generate_category_question(paper, model_name),
+        key_fn=lambda paper: paper.chunk_id,
+    )
+
+
+def stream_metadata_generation(
+    text_chunks, output_path: str, model_name: str = "gpt-3.5-turbo"
+):
+    return stream_generation(
+        text_chunks,
+        output_path,
+        lambda text_chunk: generate_metadata(text_chunk, model_name),
+    )
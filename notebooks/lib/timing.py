@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from lib.tracing import span
+import time
+
+_in_rerank: ContextVar[bool] = ContextVar("in_rerank", default=False)
+_stage_times: ContextVar[dict[str, float] | None] = ContextVar(
+    "stage_times", default=None
+)
+
+
+@contextmanager
+def record_stage(stage: str):
+    """
+    Adds the time spent inside the block to `stage` if we're currently collecting stage times, otherwise this does nothing
+    """
+    stage_times = _stage_times.get()
+    if stage_times is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[stage] = stage_times.get(stage, 0) + time.perf_counter() - start
+
+
+@contextmanager
+def collect_stage_times():
+    stage_times = {}
+    token = _stage_times.set(stage_times)
+    try:
+        yield stage_times
+    finally:
+        _stage_times.reset(token)
+
+
+def timed_reranker(reranker):
+    """
+    Rerankers are invoked by Lance inside `.to_list()` so we time them to separate reranking from the search itself. The
+    methods are wrapped once on the reranker's class rather than on the instance, so calling this on every search doesn't stack
+    wrappers and the instance can still be pickled.
+    """
+    cls = type(reranker)
+    if vars(cls).get("_timed_reranker"):
+        return reranker
+
+    for name in ["rerank_hybrid", "rerank_fts", "rerank_vector"]:
+        method = getattr(cls, name, None)
+        if method is None:
+            continue
+
+        @wraps(method)
+        def timed(self, *args, _method=method, _name=name, **kwargs):
+            # A subclass calling a wrapped parent method shouldn't count the time twice
+            if _in_rerank.get():
+                return _method(self, *args, **kwargs)
+            token = _in_rerank.set(True)
+            try:
+                with record_stage("rerank"), span(
+                    "lib.timing.rerank", reranker=type(self).__name__, method=_name
+                ):
+                    return _method(self, *args, **kwargs)
+            finally:
+                _in_rerank.reset(token)
+
+        setattr(cls, name, timed)
+    cls._timed_reranker = True
+    return reranker
@@ -0,0 +1,269 @@
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Literal
+from lib.embedding_cache import CACHE_DIR
+import bisect
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+
+DEFAULT_TRACE_PATH = os.path.join(CACHE_DIR, "traces.jsonl")
+
+# Upper bounds of the latency histogram buckets in milliseconds
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def observe(self, duration_ms: float):
+        self.counts[bisect.bisect_left(BUCKETS_MS, duration_ms)] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+
+    def percentile(self, p: float) -> float:
+        # Upper bound of the bucket the percentile falls into
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(BUCKETS_MS + [float("inf")], self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+        }
+
+
+class FileExporter:
+    """
+    Appends every finished span as a line of JSON, this works entirely offline
+    """
+
+    def __init__(self, path: str = DEFAULT_TRACE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def on_start(self, span: "Span"):
+        pass
+
+    def on_end(self, span: "Span"):
+        record = {
+            "name": span.name,
+            "span_id": span.span_id,
+            "parent_id": span.parent.span_id if span.parent else None,
+            "start": span.start_time,
+            "duration_ms": span.duration_ms,
+            "attributes": span.attributes,
+            "error": span.error,
+        }
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+class OTLPExporter:
+    def __init__(self, endpoint: str | None = None):
+        # Only imported when OTLP export is requested so the SDK stays optional
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        provider = TracerProvider(resource=Resource.create({"service.name": "rag-ws"}))
+        provider.add_span_processor(
+            BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint))
+        )
+        self._trace = trace
+        self._tracer = provider.get_tracer("lib")
+
+    def on_start(self, span: "Span"):
+        context = None
+        if span.parent is not None and span.parent.otel_span is not None:
+            context = self._trace.set_span_in_context(span.parent.otel_span)
+        span.otel_span = self._tracer.start_span(span.name, context=context)
+
+    def on_end(self, span: "Span"):
+        span.otel_span.set_attributes(
+            {
+                key: value if isinstance(value, (str, int, float, bool)) else str(value)
+                for key, value in span.attributes.items()
+            }
+        )
+        if span.error:
+            span.otel_span.set_attribute("error", span.error)
+        span.otel_span.end()
+
+
+_exporter: FileExporter | OTLPExporter | None = None
+_histograms: dict[str, LatencyHistogram] = {}
+_current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = [
+        "name",
+        "attributes",
+        "span_id",
+        "parent",
+        "start_time",
+        "duration_ms",
+        "error",
+        "otel_span",
+        "_start",
+        "_token",
+    ]
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_span_ids)
+        self.parent = None
+        self.error = None
+        self.otel_span = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        _exporter.on_start(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        _current_span.reset(self._token)
+        if exc is not None:
+            self.error = repr(exc)
+        _histograms.setdefault(self.name, LatencyHistogram()).observe(self.duration_ms)
+        _exporter.on_end(self)
+        return False
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attributes):
+    """
+    Times the block as a span called `name`. When tracing hasn't been configured this returns a shared no-op span.
+    """
+    if _exporter is None:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+
+def configure_tracing(
+    exporter: Literal["none", "file", "otlp"] = "file",
+    path: str = DEFAULT_TRACE_PATH,
+    endpoint: str | None = None,
+):
+    global _exporter
+    if exporter == "none":
+        _exporter = None
+    elif exporter == "file":
+        _exporter = FileExporter(path)
+    elif exporter == "otlp":
+        _exporter = OTLPExporter(endpoint)
+    else:
+        raise ValueError(f"Unknown exporter {exporter}")
+
+
+def get_histograms() -> dict[str, dict[str, float]]:
+    return {name: histogram.summary() for name, histogram in _histograms.items()}
+
+
+def reset_histograms():
+    _histograms.clear()
+
+
+def _count_results(results) -> int:
+    if not isinstance(results, list):
+        return 0
+    count = 0
+    for items in results:
+        # Strategies return lists of hits, Arrow tables or (ids, scores) numpy arrays per query
+        if isinstance(items, tuple):
+            count += len(items[0])
+        elif hasattr(items, "num_rows"):
+            count += items.num_rows
+        else:
+            count += len(items) if isinstance(items, list) else 1
+    return count
+
+
+def traced_search(search_fn: Callable):
+    """
+    Wraps a `lib.query` strategy in a span with the table name, top_k, number of queries and number of results attached
+    """
+    signature = inspect.signature(search_fn)
+    name = f"{search_fn.__module__}.{search_fn.__name__}"
+
+    def attributes(args, kwargs):
+        bound = signature.bind_partial(*args, **kwargs).arguments
+        # LanceTable defines __len__ as count_rows so never check a table for truthiness
+        table = bound.get("table")
+        if table is None and bound.get("tables"):
+            table = bound["tables"][0]
+        return {
+            "table": getattr(table, "name", None),
+            "top_k": bound.get("top_k"),
+            "batch_size": len(bound.get("queries") or []),
+        }
+
+    if inspect.iscoroutinefunction(search_fn):
+
+        @wraps(search_fn)
+        async def async_wrapper(*args, **kwargs):
+            if _exporter is None:
+                return await search_fn(*args, **kwargs)
+            with span(name, **attributes(args, kwargs)) as current:
+                results = await search_fn(*args, **kwargs)
+                current.set_attribute("result_count", _count_results(results))
+                return results
+
+        return async_wrapper
+
+    @wraps(search_fn)
+    def wrapper(*args, **kwargs):
+        if _exporter is None:
+            return search_fn(*args, **kwargs)
+        with span(name, **attributes(args, kwargs)) as current:
+            results = search_fn(*args, **kwargs)
+            current.set_attribute("result_count", _count_results(results))
+            return results
+
+    return wrapper
+
+
+if os.environ.get("RAG_TRACING"):
+    configure_tracing(os.environ["RAG_TRACING"])
@@ -2,17 +2,21 @@ from lib.db import (
     get_table,
     insert_data_into_async_table,
     get_table_async,
+    get_existing_chunk_ids,
+    upsert_data_into_table,
+    update_fts_index,
 )
 from lib.data import (
     generate_category_test_labels,
     get_dataset,
-    generate_data_and_labels,
+    stream_passages,
     generate_test_labels,
     save_labels,
     download_arxiv_dataset,
     format_arxiv_dataset,
 )
 from asyncio import run
+from lib.dedup import NearDuplicateIndex, load_aliases, save_aliases
 from lib.synthethic import generate_category_questions
 from lib.models import EmbeddedPassage, ArxivPaper
 import lancedb
@@ -31,9 +35,20 @@ async def setup_table():
     async_table = await get_table_async(async_db, "ms_marco")
 
     dataset = get_dataset(1000)
-    data, labels = generate_data_and_labels(dataset)
-
-    await insert_data_into_async_table(async_table, data, batch_size=500)
+    labels = []
+    near_duplicates = NearDuplicateIndex()
+
+    # Passages are content addressed so re-runs only embed and insert the ones we haven't seen before
+    existing = get_existing_chunk_ids(table)
+    start_row = table.count_rows()
+    new_passages = (
+        passage
+        for passage in stream_passages(dataset, labels, near_duplicates)
+        if passage["chunk_id"] not in existing
+    )
+    await insert_data_into_async_table(async_table, new_passages, batch_size=500)
+    # Labels that point at a collapsed duplicate are resolved against these when read, see `lib.data.get_labels`
+    save_aliases({**load_aliases(), **near_duplicates.aliases})
 
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
@@ -48,15 +63,15 @@ async def setup_table():
         multi_label = generate_test_labels(labels, False)
         save_labels(multi_label, multi_label_path)
 
-    table.create_fts_index("text", replace=True)
+    # The rows were written through the async connection so we reopen the table to see them
+    table = get_table(db, "ms_marco")
+    update_fts_index(table, "text", start_row)
 
 
 async def setup_metadata_example():
     db = lancedb.connect(LANCE_DIR_PATH)
-    async_db = await lancedb.connect_async(LANCE_DIR_PATH)
 
     table = get_table(db, "arxiv_papers", ArxivPaper)
-    async_table = await get_table_async(async_db, "arxiv_papers")
 
     dataset = download_arxiv_dataset(100)
     data = format_arxiv_dataset(dataset)
@@ -65,9 +80,8 @@ async def setup_metadata_example():
     if not os.path.exists(metadata_path):
         save_labels(data, metadata_path)
 
-    await insert_data_into_async_table(async_table, data, batch_size=50)
-
-    table.create_fts_index("text", replace=True)
+    stats = upsert_data_into_table(table, data, batch_size=50)
+    update_fts_index(table, "text", stats["start_row"], rebuild=stats["updated"] > 0)
 
     category_questions_path = os.path.join(DATA_DIR, "category_questions.jsonl")
     if not os.path.exists(category_questions_path):